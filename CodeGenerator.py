@@ -0,0 +1,216 @@
+from JackAST import (LetStatement, IfStatement, WhileStatement, DoStatement, ReturnStatement, BinaryOp, UnaryOp,
+        IntegerConstant, StringConstant, KeywordConstant, VarName, ArrayAccess, SubroutineCall)
+from SymbolTable import SymbolTable
+
+
+class CodeGenerationError(Exception):
+    pass
+
+KIND_SEGMENTS = {"static": "static", "field": "this", "arg": "argument", "var": "local"}
+
+BINARY_COMMANDS = {"+": "add", "-": "sub", "&": "and", "|": "or", "<": "lt", ">": "gt", "=": "eq"}
+BINARY_CALLS = {"*": "Math.multiply", "/": "Math.divide"}
+UNARY_COMMANDS = {"-": "neg", "~": "not"}
+
+
+class CodeGenerator(object):
+    # walks the AST of one class and writes its vm code through a VMWriter
+    def __init__(self, writer):
+        self.writer = writer
+        self.symbol_table = SymbolTable()
+        self.class_name = None
+        self.label_count = 0
+        # vm argument counts of the subroutines defined, and the calls made
+        # as (name, args, line), for checking calls between classes
+        self.functions = {}
+        self.calls = []
+
+    def _error(self, node, message):
+        raise CodeGenerationError("{}:{}: {}".format(self.class_name, node.line, message))
+
+    def _label(self, name):
+        label = "{}{}".format(name, self.label_count)
+        self.label_count += 1
+        return label
+
+    def write_class(self, node):
+        self.class_name = node.name
+        for var_dec in node.class_vars:
+            for name in var_dec.names:
+                self.symbol_table.define(name, var_dec.type, var_dec.kind)
+        for subroutine in node.subroutines:
+            self.write_subroutine(subroutine)
+
+    def write_subroutine(self, node):
+        self.symbol_table.startSubroutine()
+        self.label_count = 0
+        if node.kind == "method":
+            self.symbol_table.define("this", self.class_name, "arg")
+        for type, name in node.parameters:
+            self.symbol_table.define(name, type, "arg")
+        for var_dec in node.local_vars:
+            for name in var_dec.names:
+                self.symbol_table.define(name, var_dec.type, "var")
+
+        name = "{}.{}".format(self.class_name, node.name)
+        self.functions[name] = self.symbol_table.varCount("arg")
+        self.writer.writeFunction(name, self.symbol_table.varCount("var"))
+        if node.kind == "constructor":
+            self.writer.writePush("constant", self.symbol_table.varCount("field"))
+            self.writer.writeCall("Memory.alloc", 1)
+            self.writer.writePop("pointer", 0)
+        elif node.kind == "method":
+            self.writer.writePush("argument", 0)
+            self.writer.writePop("pointer", 0)
+        self.write_statements(node.statements)
+
+    def write_statements(self, statements):
+        for statement in statements:
+            STATEMENT_WRITERS[type(statement)](self, statement)
+
+    def write_let(self, node):
+        if node.index is None:
+            self.write_expression(node.value)
+            self._pop_variable(node, node.name)
+            return
+        # pointer 1 is only set once the value is computed, since the
+        # value may index an array itself
+        self._push_variable(node, node.name)
+        self.write_expression(node.index)
+        self.writer.writeArithmetic("add")
+        self.write_expression(node.value)
+        self.writer.writePop("temp", 0)
+        self.writer.writePop("pointer", 1)
+        self.writer.writePush("temp", 0)
+        self.writer.writePop("that", 0)
+
+    def write_if(self, node):
+        else_label = self._label("IF_ELSE")
+        self.write_expression(node.condition)
+        self.writer.writeArithmetic("not")
+        self.writer.writeIf(else_label)
+        self.write_statements(node.statements)
+        if node.else_statements is None:
+            self.writer.writeLabel(else_label)
+            return
+        end_label = self._label("IF_END")
+        self.writer.writeGoto(end_label)
+        self.writer.writeLabel(else_label)
+        self.write_statements(node.else_statements)
+        self.writer.writeLabel(end_label)
+
+    def write_while(self, node):
+        loop_label = self._label("WHILE_EXP")
+        end_label = self._label("WHILE_END")
+        self.writer.writeLabel(loop_label)
+        self.write_expression(node.condition)
+        self.writer.writeArithmetic("not")
+        self.writer.writeIf(end_label)
+        self.write_statements(node.statements)
+        self.writer.writeGoto(loop_label)
+        self.writer.writeLabel(end_label)
+
+    def write_do(self, node):
+        self.write_call(node.call)
+        self.writer.writePop("temp", 0)
+
+    def write_return(self, node):
+        if node.value is None:
+            self.writer.writePush("constant", 0)
+        else:
+            self.write_expression(node.value)
+        self.writer.writeReturn()
+
+    def write_expression(self, node):
+        EXPRESSION_WRITERS[type(node)](self, node)
+
+    def write_binary(self, node):
+        self.write_expression(node.left)
+        self.write_expression(node.right)
+        if node.op in BINARY_CALLS:
+            self.writer.writeCall(BINARY_CALLS[node.op], 2)
+        else:
+            self.writer.writeArithmetic(BINARY_COMMANDS[node.op])
+
+    def write_unary(self, node):
+        self.write_expression(node.operand)
+        self.writer.writeArithmetic(UNARY_COMMANDS[node.op])
+
+    def write_integer(self, node):
+        self.writer.writePush("constant", node.value)
+
+    def write_string(self, node):
+        self.writer.writePush("constant", len(node.value))
+        self.writer.writeCall("String.new", 1)
+        for c in node.value:
+            self.writer.writePush("constant", ord(c))
+            self.writer.writeCall("String.appendChar", 2)
+
+    def write_keyword(self, node):
+        if node.value == "this":
+            self.writer.writePush("pointer", 0)
+        else:
+            self.writer.writePush("constant", 0)
+            if node.value == "true":
+                self.writer.writeArithmetic("not")
+
+    def write_var_name(self, node):
+        self._push_variable(node, node.name)
+
+    def write_array_access(self, node):
+        self._push_variable(node, node.name)
+        self.write_expression(node.index)
+        self.writer.writeArithmetic("add")
+        self.writer.writePop("pointer", 1)
+        self.writer.writePush("that", 0)
+
+    def write_call(self, node):
+        args = len(node.arguments)
+        if node.receiver is None:
+            # a method of this class on the current object
+            self.writer.writePush("pointer", 0)
+            name = "{}.{}".format(self.class_name, node.name)
+            args += 1
+        elif self.symbol_table.kindOf(node.receiver) is not None:
+            # a method call on an object held in a variable
+            self._push_variable(node, node.receiver)
+            name = "{}.{}".format(self.symbol_table.typeOf(node.receiver), node.name)
+            args += 1
+        else:
+            name = "{}.{}".format(node.receiver, node.name)
+        for argument in node.arguments:
+            self.write_expression(argument)
+        self.writer.writeCall(name, args)
+        self.calls.append((name, args, node.line))
+
+    def _segment(self, node, name):
+        kind = self.symbol_table.kindOf(name)
+        if kind is None:
+            self._error(node, "{} is not defined".format(name))
+        return KIND_SEGMENTS[kind], self.symbol_table.indexOf(name)
+
+    def _push_variable(self, node, name):
+        self.writer.writePush(*self._segment(node, name))
+
+    def _pop_variable(self, node, name):
+        self.writer.writePop(*self._segment(node, name))
+
+
+STATEMENT_WRITERS = {
+    LetStatement: CodeGenerator.write_let,
+    IfStatement: CodeGenerator.write_if,
+    WhileStatement: CodeGenerator.write_while,
+    DoStatement: CodeGenerator.write_do,
+    ReturnStatement: CodeGenerator.write_return,
+}
+
+EXPRESSION_WRITERS = {
+    BinaryOp: CodeGenerator.write_binary,
+    UnaryOp: CodeGenerator.write_unary,
+    IntegerConstant: CodeGenerator.write_integer,
+    StringConstant: CodeGenerator.write_string,
+    KeywordConstant: CodeGenerator.write_keyword,
+    VarName: CodeGenerator.write_var_name,
+    ArrayAccess: CodeGenerator.write_array_access,
+    SubroutineCall: CodeGenerator.write_call,
+}
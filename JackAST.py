@@ -0,0 +1,75 @@
+class Node(object):
+    # fields are the subclass __slots__, in order; line is the source line
+    # the node starts at, for error messages
+    __slots__ = ("line",)
+
+    def __init__(self, *values, **kwargs):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+        self.line = kwargs.get("line")
+
+    def fields(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.fields() == other.fields()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(repr(value) for name, value in self.fields()))
+
+
+class Class(Node):
+    __slots__ = ("name", "class_vars", "subroutines")
+
+class VarDec(Node):
+    # kind is static, field or var
+    __slots__ = ("kind", "type", "names")
+
+class Subroutine(Node):
+    # parameters are (type, name) pairs
+    __slots__ = ("kind", "return_type", "name", "parameters", "local_vars", "statements")
+
+
+class LetStatement(Node):
+    # index is None unless an array element is assigned
+    __slots__ = ("name", "index", "value")
+
+class IfStatement(Node):
+    # else_statements is None without an else branch
+    __slots__ = ("condition", "statements", "else_statements")
+
+class WhileStatement(Node):
+    __slots__ = ("condition", "statements")
+
+class DoStatement(Node):
+    __slots__ = ("call",)
+
+class ReturnStatement(Node):
+    # value is None for a plain return
+    __slots__ = ("value",)
+
+
+class BinaryOp(Node):
+    __slots__ = ("op", "left", "right")
+
+class UnaryOp(Node):
+    __slots__ = ("op", "operand")
+
+class IntegerConstant(Node):
+    __slots__ = ("value",)
+
+class StringConstant(Node):
+    __slots__ = ("value",)
+
+class KeywordConstant(Node):
+    __slots__ = ("value",)
+
+class VarName(Node):
+    __slots__ = ("name",)
+
+class ArrayAccess(Node):
+    __slots__ = ("name", "index")
+
+class SubroutineCall(Node):
+    # receiver is the class or variable before the dot, None for f(...)
+    __slots__ = ("receiver", "name", "arguments")
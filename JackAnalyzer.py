@@ -1,16 +1,19 @@
+import hashlib
 import html
+import json
 import os
 import re
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
-from SymbolTable import SymbolTable
+from CodeGenerator import CodeGenerator, CodeGenerationError
+from JackAST import (Node, Class, VarDec, Subroutine, LetStatement, IfStatement, WhileStatement, DoStatement,
+        ReturnStatement, BinaryOp, UnaryOp, IntegerConstant, StringConstant, KeywordConstant, VarName, ArrayAccess,
+        SubroutineCall)
 from VMWriter import VMWriter
 
-IDENTIFIER_RE = re.compile("^[^\"\d]+\w*")
-INTEGER_CONSTANT_RE = re.compile("^\d+")
-STRING_CONSTANT_RE = re.compile("^\"[^\"\n]+\"")
-
 KEYWORDS = ["class", "constructor", "function", "method", "field", "static", "var", "int", "char", "boolean", "void", "true", "false",
     "null", "this", "let", "do", "if", "else", "while", "return"
 ]
@@ -18,6 +21,29 @@ KEYWORDS = ["class", "constructor", "function", "method", "field", "static", "va
 
 SYMBOLS = ["{", "}", "(", ")", "[", "]", ".", ",", ";", "+", "-", "*", "/", "&", "|", "<", ">", "=", "~"]
 
+MANIFEST_NAME = ".jack_manifest.json"
+MANIFEST_VERSION = 2
+
+OPS = ("+", "-", "*", "/", "&", "|", "<", ">", "=")
+
+# the whole lexer: each match skips blanks and comments, then takes one
+# token. Alternatives are tried in order, so an unclosed comment or
+# string is reported before "/" could match as a symbol
+TOKEN_RE = re.compile(r"""
+    (?:\s+|//[^\n]*|/\*.*?\*/)*
+    (?:
+      (?P<word>[A-Za-z_]\w*)
+    | (?P<integer>\d+)
+    | (?P<string>"[^"\n]*")
+    | (?P<unclosed>/\*|")
+    | (?P<symbol>[{}])
+    | (?P<end>\Z)
+    | (?P<error>.)
+    )
+""".format(re.escape("".join(SYMBOLS))), re.VERBOSE | re.DOTALL)
+
+KEYWORD_SET = frozenset(KEYWORDS)
+
 class TokenType(Enum):
     KEYWORD = 0
     SYMBOL = 1
@@ -93,88 +119,65 @@ class TokenizeError(Exception):
 class CompilationError(Exception):
     pass
 
+
+class Token(object):
+    # one classified token; value is an int for integer constants and the
+    # text without quotes for string constants
+    __slots__ = ("kind", "value", "line", "column")
+
+    def __init__(self, kind, value, line, column):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.column = column
+
+    def __repr__(self):
+        return "Token({}, {!r}, {}, {})".format(self.kind, self.value, self.line, self.column)
+
+
 class JackTokenizer(object):
     def __init__(self, file_):
-        self.lines = []
-        comment_line = False
-        for line in file_.readlines():
-            if "/*" in line:
-                comment_line = True
-            if "*/" in line:
-                line = line.split("*/")[-1]
-                comment_line = False
-            if not comment_line:
-                self.lines.append(line)
-        self._split_tokens()
+        self.tokens = self._split_tokens(file_.read())
         self.token_sum = len(self.tokens)
         self.now_token = 0
         self._set_token()
 
-    def _split_line_include_quote_line(self, line):
-        is_quoted = False
-        splited_line = []
-        w2 = ""
-        for w in line:
-            if is_quoted:
-                w2 += w
-                if w == "\"":
-                    splited_line.append(w2)
-                    is_quoted = False
-                    w2 = ""
-            elif w == "\"":
-                if len(w2) > 0:
-                    splited_line.append(w2)
-                is_quoted = True
-                w2 = "\""
-            elif w == " ":
-                if len(w2) > 0:
-                    splited_line.append(w2)
-                    w2 = ""
-            else:
-                w2 += w
-        if len(w2) > 0:
-            splited_line.append(w2)
-        return splited_line
-
-    def _split_tokens(self):
+    def _split_tokens(self, source):
+        # one pass of TOKEN_RE over the whole file; lines are counted
+        # between consecutive tokens
         tokens = []
-        for line in self.lines:
-            normalized_line = self._normalize(line)
-            words = None
-            if "\"" in normalized_line:
-                words = self._split_line_include_quote_line(normalized_line)
-            else:
-                words = normalized_line.split(" ")
-            for word in words:
-                # check token keyword
-                if word in KEYWORDS:
-                    tokens.append(word)
-                    continue
-                tokens.extend(self._word_split_tokens(word))
-        self.tokens = tokens
-
-    def _word_split_tokens(self, word):
-        tokens = []
-        w2 = ""
-        for w in word:
-            if w in SYMBOLS:
-                if len(w2) > 0:
-                    tokens.append(w2)
-                    w2 = ""
-                tokens.append(w)
-                continue
+        line = 1
+        line_start = 0
+        position = 0
+        for match in TOKEN_RE.finditer(source):
+            group = match.lastgroup
+            start = match.start(group)
+            newlines = source.count("\n", position, start)
+            if newlines:
+                line += newlines
+                line_start = source.rfind("\n", position, start) + 1
+            position = start
+            text = match.group(group)
+            if group == "word":
+                kind = TokenType.KEYWORD if text in KEYWORD_SET else TokenType.IDENTIFIER
+                tokens.append(Token(kind, text, line, start - line_start + 1))
+            elif group == "symbol":
+                tokens.append(Token(TokenType.SYMBOL, text, line, start - line_start + 1))
+            elif group == "integer":
+                tokens.append(Token(TokenType.INT_CONST, int(text), line, start - line_start + 1))
+            elif group == "string":
+                tokens.append(Token(TokenType.STRING_CONST, text[1:-1], line, start - line_start + 1))
+            elif group == "end":
+                break
+            elif group == "unclosed":
+                raise TokenizeError("{}:{}: unclosed {}".format(line, start - line_start + 1,
+                        "comment" if text == "/*" else "string"))
             else:
-                w2 += w 
-        if len(w2) > 0:
-            tokens.append(w2)
+                raise TokenizeError("{}:{}: cant parse token {}".format(line, start - line_start + 1, text))
         return tokens
-            
-    def _normalize(self, line):
-        line = line.split("//")[0].strip()
-        return line.split("/*")[0].strip()
 
     def _set_token(self):
-        self.token = self.tokens[self.now_token]
+        self.token = self.tokens[self.now_token] if self.tokens else None
 
     def advance(self):
         if self.hasMoreTokens():
@@ -185,573 +188,561 @@ class JackTokenizer(object):
         return self.now_token < self.token_sum - 1
 
     def tokenType(self):
-        token = self.token
-        if self.is_keyword(token):
-            return TokenType.KEYWORD
-        elif self.is_symbol(token):
-            return TokenType.SYMBOL
-        elif self.is_identifier(token):
-            return TokenType.IDENTIFIER
-        elif self.is_integer_constant(token):
-            return TokenType.INT_CONST
-        elif self.is_string_constant(token):
-            return TokenType.STRING_CONST
-
-    def is_keyword(self, token):
-        if token in KEYWORDS:
-            return True
-        return False
+        return self.token.kind
 
-    def is_symbol(self, token):
-        if token in SYMBOLS:
-            return True
-        return False
+    def keyword(self):
+        return self.token.value
 
-    def is_identifier(self, token):
-        if IDENTIFIER_RE.match(token):
-            return True
-        return False
+    def symbol(self):
+        return self.token.value
 
-    def is_integer_constant(self, token):
-        if INTEGER_CONSTANT_RE.match(token):
-            return True
-        return False
+    def identifier(self):
+        return self.token.value
 
-    def is_string_constant(self, token):
-        if STRING_CONSTANT_RE.match(token):
-            return True
-        return False
+    def intVal(self):
+        return self.token.value
+
+    def stringVal(self):
+        return self.token.value
 
-    def keyword(self):
-        return self.token
 
-    def write_token(self, token, tokenType, wf):
-        tag_name = tokenType.get_tag()
-        wf.write("<{}> {} </{}>\n".format(tag_name, html.escape(str(token)), tag_name))
+def token_xml(token):
+    tag_name = token.kind.get_tag()
+    return "<{}> {} </{}>\n".format(tag_name, html.escape(str(token.value)), tag_name)
 
 
 class CompilationEngine(object):
-    def __init__(self, path):
-        f = open("{}".format(path), "r") 
-        self.file = f
-        self.lines = []
-        for line in f.readlines():
-            self.lines.append(line)
+    # recursive descent over the token list of one class; compile() returns
+    # the class AST and now_line is the index of the current token
+    def __init__(self, tokens):
+        self.tokens = tokens
         self.now_line = 0
-        self.symbol_table = SymbolTable()
-
-    def write(self):
-        self.write_file.writelines(self.write_lines)
-
-    def close(self):
-        self.file.close()
-        self.write_file.close()
 
     def advance(self):
         self.now_line += 1
 
     def get_line(self, line_num):
-        return self.lines[line_num]
+        if line_num >= len(self.tokens):
+            raise CompilationError("unexpected end of file")
+        return self.tokens[line_num]
 
     def _get_token(self, line_num):
-        line = self.get_line(line_num)
-        return line.split(" ")[1]
+        return str(self.get_line(line_num).value)
 
     def _get_tag(self, line_num):
-        line = self.get_line(line_num)
-        return line.split(">")[0].strip("<")
+        return self.get_line(line_num).kind.get_tag()
 
-    def _start_non_terminal(self, non_term):
-        self.write_lines.append("<{}>\n".format(non_term))
+    def _get_position(self):
+        return self.get_line(self.now_line).line
 
-    def _end_non_terminal(self, non_term):
-        self.write_lines.append("</{}>\n".format(non_term))
+    def _is_symbol(self, line_num, *symbols):
+        # by kind as well as value: a string constant ")" is not a symbol
+        token = self.get_line(line_num)
+        return token.kind == TokenType.SYMBOL and token.value in symbols
 
-    def write_line(self, line):
-        self.write_lines.append(self.lines[line])
+    def _is_keyword(self, line_num, *keywords):
+        token = self.get_line(line_num)
+        return token.kind == TokenType.KEYWORD and token.value in keywords
 
-    def append_line(self, s):
-        self.write_lines.append(s + "\n")
+    def _expect(self, token, message):
+        if not (self._is_symbol(self.now_line, token) or self._is_keyword(self.now_line, token)):
+            raise CompilationError(message)
+        self.advance()
 
-    def is_type(self, line):
-        if self._get_tag(self.now_line) not in ("keyword", "identifier"):
-            return False
-        if self._get_token(self.now_line) not in ("int", "char", "boolean"):
-            return False
-        return True
+    def _identifier(self, message):
+        if self._get_tag(self.now_line) != "identifier":
+            raise CompilationError(message)
+        name = self._get_token(self.now_line)
+        self.advance()
+        return name
+
+    def _type(self, message):
+        token = self.get_line(self.now_line)
+        if token.kind != TokenType.IDENTIFIER and token.value not in ("int", "char", "boolean"):
+            raise CompilationError(message)
+        self.advance()
+        return token.value
 
     def is_op(self, line):
-        if self._get_token(line) not in [html.escape(x) for x in ("+", "-", "*", "/", "&", "|", "<", ">", "=")]:
-            return False
-        return True
-        
+        return self._is_symbol(line, *OPS)
+
     def compile(self):
-        line = self.lines[self.now_line]
-        if line.strip().strip("<  >") != "tokens":
-            raise CompilationError("xml is not started with 'tokens'")
-        self.advance()
-        self.compileClass()
-        self.lines[self.now_line]
-        if self.lines[self.now_line].strip().strip("<  >") != "/tokens":
-            raise CompilationError("xml is not end with '/tokens'")
+        try:
+            node = self.compileClass()
+            if self.now_line != len(self.tokens):
+                raise CompilationError("tokens after the end of class")
+        except CompilationError as e:
+            token = self.tokens[min(self.now_line, len(self.tokens) - 1)] if self.tokens else None
+            if token is None:
+                raise
+            raise CompilationError("{}:{}: {}".format(token.line, token.column, e))
+        return node
 
     def compileClass(self):
-        token = self._get_token(self.now_line)
-        if token != "class":
-            raise CompilationError("programm is not started with 'class'")
-        self.advance()
-        class_name = self._compileClassName()
-        self.writer = VMWriter(class_name)
-        self.advance()
-        if self._get_token(self.now_line) != "{":
-            raise CompilationError("class body is not started with '{'")
-        self.advance()
-        while self._get_token(self.now_line) != "}":
+        line = self._get_position()
+        self._expect("class", "programm is not started with 'class'")
+        class_name = self._identifier("'class' is undefined 'className'")
+        self._expect("{", "class body is not started with '{'")
+        class_vars = []
+        subroutines = []
+        while not self._is_symbol(self.now_line, "}"):
             # compile class variable and subroutineDec
-            if self._get_token(self.now_line) in ("static", "field"):
-                self.compileClassVarDec()
-            elif self._get_token(self.now_line) in ("constructor", "function", "method"):
-                self.symbol_table.startSubroutine()
-                self.symbol_table.define("this", class_name, "arg")
-                self.compileSubroutineDec()
+            if self._is_keyword(self.now_line, "static", "field"):
+                class_vars.append(self.compileClassVarDec())
+            elif self._is_keyword(self.now_line, "constructor", "function", "method"):
+                subroutines.append(self.compileSubroutineDec())
             else:
                 raise CompilationError("contain disable definition in class")
-        self.write_line(self.now_line)
         self.advance()
-        self._end_non_terminal("class")
+        return Class(class_name, class_vars, subroutines, line=line)
 
     def compileClassVarDec(self):
-        if self._get_token(self.now_line) not in ("static", "field"):
-            raise CompilationError("class var dec is not started with 'static' or 'field'")
-        self._start_non_terminal("classVarDec")
+        line = self._get_position()
         kind = self._get_token(self.now_line)
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_tag(self.now_line) not in ("keyword", "identifier"):
-            raise CompilationError("type is supported 'keyword' or 'identifier'")
-        type = self._get_token(self.now_line)
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_tag(self.now_line) != "identifier":
-            raise CompilationError("'varName' need to be identifier") 
-        var_name = self._get_token(self.now_line)
-        self.symbol_table.define(var_name, type, kind)
-        self.append_line("<identified>defined: {} {} {} {}</identifier>".format(kind, type, var_name, self.symbol_table.varCount(kind)))
+        if kind not in ("static", "field"):
+            raise CompilationError("class var dec is not started with 'static' or 'field'")
         self.advance()
-        while (self._get_token(self.now_line) == ","):
-            self.write_line(self.now_line)
+        type = self._type("type is supported 'keyword' or 'identifier'")
+        names = [self._identifier("'varName' need to be identifier")]
+        while self._is_symbol(self.now_line, ","):
             self.advance()
-            var_name = self._get_token(self.now_line)
-            self.symbol_table.define(var_name, type, kind)
-            self.append_line("<identified>defined: {} {} {} {}</identifier>".format(kind, type, var_name, self.symbol_table.varCount(kind)))
-            self.advance()
-        if self._get_token(self.now_line) != ";":
-            raise CompilationError("';' need end of class var") 
-        self.write_line(self.now_line)
-        self.advance()
-        self._end_non_terminal("classVarDec")
+            names.append(self._identifier("'varName' need to be identifier"))
+        self._expect(";", "';' need end of class var")
+        return VarDec(kind, type, names, line=line)
 
     def compileSubroutineDec(self):
-        self._start_non_terminal("subroutineDec")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_token(self.now_line) not in ("void", "type") and self._get_tag(self.now_line) != "identifier":
-            raise CompilationError("subroutine return type undefined")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_tag(self.now_line) != "identifier":
-            raise CompilationError("subroutine needs subroutineName")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_tag(self.now_line) == "(":
-            raise CompilationError("subroutine needs '('")
-        self.write_line(self.now_line)
-        self.advance()
-        self.compileParameterList()
-        self.write_line(self.now_line)
-        self.advance()
-        self.compileSubroutineBody()
-        self._end_non_terminal("subroutineDec")
-
-    def compileSubroutineBody(self):
-        self._start_non_terminal("subroutineBody")
-        if self._get_token(self.now_line) != "{":
-            raise CompilationError("subroutine body needs '{'")
-        self.write_line(self.now_line)
-        self.advance()
-        while self._get_token(self.now_line) == "var":
-            self.compileVarDec()
-        self.compileStatements()
-        if self._get_token(self.now_line) != "}":
-            raise CompilationError("subroutine body needs '}'")
-        self.write_line(self.now_line)
-        self.advance()
-        self._end_non_terminal("subroutineBody")
-
-    def compileSubroutineCall(self):
-        #self._start_non_terminal("subroutineCall")
-        self.write_line(self.now_line)
+        line = self._get_position()
+        kind = self._get_token(self.now_line)
         self.advance()
-        if self._get_token(self.now_line) == "(":
-            self.write_line(self.now_line)
-            self.advance()
-            self.compileExpressionList()
-            self.write_line(self.now_line)
+        if self._is_keyword(self.now_line, "void"):
+            return_type = "void"
             self.advance()
-        elif self._get_token(self.now_line) == ".":
-            self.write_line(self.now_line)
-            self.advance()
-            self.write_line(self.now_line)
-            self.advance()
-            self.write_line(self.now_line)
-            self.advance()
-            self.compileExpressionList()
-            self.write_line(self.now_line)
+        else:
+            return_type = self._type("subroutine return type undefined")
+        name = self._identifier("subroutine needs subroutineName")
+        self._expect("(", "subroutine needs '('")
+        parameters = self.compileParameterList()
+        self._expect(")", "subroutine needs ')'")
+        local_vars, statements = self.compileSubroutineBody()
+        return Subroutine(kind, return_type, name, parameters, local_vars, statements, line=line)
+
+    def compileParameterList(self):
+        parameters = []
+        if self._is_symbol(self.now_line, ")"):
+            return parameters
+        type = self._type("type is supported 'keyword' or 'identifier'")
+        parameters.append((type, self._identifier("varName is supported 'identifier'")))
+        while self._is_symbol(self.now_line, ","):
             self.advance()
-        #self._end_non_terminal("subroutineCall")
+            type = self._type("type is supported 'keyword' or 'identifier'")
+            parameters.append((type, self._identifier("varName is supported 'identifier'")))
+        return parameters
 
-    def compileExpressionList(self):
-        self._start_non_terminal("expressionList")
-        while self._get_token(self.now_line) != ")":
-            self.compileExpression()
-            if self._get_token(self.now_line) == ",":
-                self.write_line(self.now_line)
-                self.advance()
-        self._end_non_terminal("expressionList")
+    def compileSubroutineBody(self):
+        self._expect("{", "subroutine body needs '{'")
+        local_vars = []
+        while self._is_keyword(self.now_line, "var"):
+            local_vars.append(self.compileVarDec())
+        statements = self.compileStatements()
+        self._expect("}", "subroutine body needs '}'")
+        return local_vars, statements
 
     def compileVarDec(self):
-        self._start_non_terminal("varDec")
-        if self._get_token(self.now_line) != "var":
-            raise CompilationError("var dec needs to be started with 'var'")
-        kind = self._get_token(self.now_line)
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_tag(self.now_line) not in ("keyword", "identifier"):
-            raise CompilationError("type is supported 'keyword' or 'identifier'")
-        type = self._get_token(self.now_line)
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_tag(self.now_line) != "identifier":
-            raise CompilationError("varName is supported only 'identifier'")
-        var_name = self._get_token(self.now_line)
-        self.symbol_table.define(var_name, type, kind)
-        self.append_line("<identifier>defined: {} {} {} {}</identifier>".format(kind, type, var_name, self.symbol_table.varCount(kind)))
-        self.advance()
-        while self._get_token(self.now_line) == ",":
-            self.write_line(self.now_line)
+        line = self._get_position()
+        self._expect("var", "var dec needs to be started with 'var'")
+        type = self._type("type is supported 'keyword' or 'identifier'")
+        names = [self._identifier("varName is supported only 'identifier'")]
+        while self._is_symbol(self.now_line, ","):
             self.advance()
-            if self._get_tag(self.now_line) != "identifier":
-                raise CompilationError("varName is supported only 'identifier'")
-            var_name = self._get_token(self.now_line)
-            self.symbol_table.define(var_name, type, kind)
-            self.append_line("<identifier>defined: {} {} {} {}</identifier>".format(kind, type, var_name, self.symbol_table.varCount(kind)))
-            self.advance()
-        if self._get_token(self.now_line) != ";":
-            raise CompilationError("varName needs to be ended with ';'")
-        self.write_line(self.now_line)
-        self.advance()
-        self._end_non_terminal("varDec")
+            names.append(self._identifier("varName is supported only 'identifier'"))
+        self._expect(";", "varName needs to be ended with ';'")
+        return VarDec("var", type, names, line=line)
 
     def compileStatements(self):
-        self._start_non_terminal("statements")
+        statements = []
         while self.is_statement():
-            self.compileStatement()
-        self._end_non_terminal("statements")
+            statements.append(self.compileStatement())
+        return statements
 
     def is_statement(self):
-        token = self._get_token(self.now_line)
-        if token in ("let", "if", "while", "do", "return"):
+        token = self.get_line(self.now_line)
+        if token.kind == TokenType.KEYWORD and token.value in ("let", "if", "while", "do", "return"):
             return True
         return False
 
     def compileStatement(self):
         token = self._get_token(self.now_line)
         if token == "let":
-            self.compileLet()
+            return self.compileLet()
         elif token == "do":
-            self.compileDo()
+            return self.compileDo()
         elif token == "while":
-            self.compileWhile()
+            return self.compileWhile()
         elif token == "return":
-            self.compileReturn()
+            return self.compileReturn()
         elif token == "if":
-            self.compileIf()
+            return self.compileIf()
 
     def compileLet(self):
-        self._start_non_terminal("letStatement")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_tag(self.now_line) != "identifier":
-            raise CompilationError("varName is supported only 'identifier'")
-        var_name = self._get_token(self.now_line)
-        kind = self.symbol_table.kindOf(var_name)
-        type = self.symbol_table.typeOf(var_name)
-        index = self.symbol_table.typeOf(var_name)
-        self.append_line("<identifier>used: {} {} {} {}</identifier>".format(kind, type, var_name, index))
+        line = self._get_position()
         self.advance()
-        if self._get_token(self.now_line) == "[":
-            self.write_line(self.now_line)
-            self.advance()
-            self.compileExpression()
-            self.write_line(self.now_line)
+        var_name = self._identifier("varName is supported only 'identifier'")
+        index = None
+        if self._is_symbol(self.now_line, "["):
             self.advance()
-        if self._get_token(self.now_line) != "=":
-            raise CompilationError("let needs '=' to assign variable")
-        self.write_line(self.now_line)
-        self.advance()
-        self.compileExpression()
-        if self._get_token(self.now_line) != ";":
-            raise CompilationError("let needs ';' to end let")
-        self.write_line(self.now_line)
-        self.advance()
-        self._end_non_terminal("letStatement")
+            index = self.compileExpression()
+            self._expect("]", "let needs ']' to close index")
+        self._expect("=", "let needs '=' to assign variable")
+        value = self.compileExpression()
+        self._expect(";", "let needs ';' to end let")
+        return LetStatement(var_name, index, value, line=line)
 
     def compileIf(self):
-        self._start_non_terminal("ifStatement")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_token(self.now_line) != "(":
-            raise CompilationError("if needs '(' to describe condition")
-        self.write_line(self.now_line)
-        self.advance()
-        self.compileExpression()
-        if self._get_token(self.now_line) != ")":
-            raise CompilationError("if needs ')' to describe condition")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_token(self.now_line) != "{":
-            raise CompilationError("if needs '{' to provide statements")
-        self.write_line(self.now_line)
-        self.advance()
-        self.compileStatements()
-        if self._get_token(self.now_line) != "}":
-            raise CompilationError("if needs '}' to provide statements")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_token(self.now_line) == "else":
-            self.write_line(self.now_line)
-            self.advance()
-            if self._get_token(self.now_line) != "{":
-                raise CompilationError("else needs '{' to provide statements")
-            self.write_line(self.now_line)
+        line = self._get_position()
+        self.advance()
+        self._expect("(", "if needs '(' to describe condition")
+        condition = self.compileExpression()
+        self._expect(")", "if needs ')' to describe condition")
+        self._expect("{", "if needs '{' to provide statements")
+        statements = self.compileStatements()
+        self._expect("}", "if needs '}' to provide statements")
+        else_statements = None
+        if self._is_keyword(self.now_line, "else"):
             self.advance()
-            self.compileStatements()
-            if self._get_token(self.now_line) != "}":
-                raise CompilationError("else needs '}' to provide statements")
-            self.write_line(self.now_line)
-            self.advance()
-        self._end_non_terminal("ifStatement")
+            self._expect("{", "else needs '{' to provide statements")
+            else_statements = self.compileStatements()
+            self._expect("}", "else needs '}' to provide statements")
+        return IfStatement(condition, statements, else_statements, line=line)
 
     def compileWhile(self):
-        self._start_non_terminal("whileStatement")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_token(self.now_line) != "(":
-            raise CompilationError("while needs '(' to describe condition")
-        self.write_line(self.now_line)
+        line = self._get_position()
         self.advance()
-        self.compileExpression()
-        if self._get_token(self.now_line) != ")":
-            raise CompilationError("while needs ')' to describe condition")
-        self.write_line(self.now_line)
-        self.advance()
-        if self._get_token(self.now_line) != "{":
-            raise CompilationError("while needs '{' to provide statements")
-        self.write_line(self.now_line)
-        self.advance()
-        self.compileStatements()
-        if self._get_token(self.now_line) != "}":
-            raise CompilationError("while needs '}' to provide statements")
-        self.write_line(self.now_line)
-        self.advance()
-        self._end_non_terminal("whileStatement")
+        self._expect("(", "while needs '(' to describe condition")
+        condition = self.compileExpression()
+        self._expect(")", "while needs ')' to describe condition")
+        self._expect("{", "while needs '{' to provide statements")
+        statements = self.compileStatements()
+        self._expect("}", "while needs '}' to provide statements")
+        return WhileStatement(condition, statements, line=line)
 
     def compileDo(self):
-        self._start_non_terminal("doStatement")
-        self.write_line(self.now_line)
-        self.advance()
-        self.compileSubroutineCall()
-        if self._get_token(self.now_line) != ";":
-            raise CompilationError("do needs ';' to describe condition")
-        self.write_line(self.now_line)
+        line = self._get_position()
         self.advance()
-        self._end_non_terminal("doStatement")
+        call = self.compileSubroutineCall()
+        self._expect(";", "do needs ';' to describe condition")
+        return DoStatement(call, line=line)
 
     def compileReturn(self):
-        self._start_non_terminal("returnStatement")
-        self.write_line(self.now_line)
+        line = self._get_position()
         self.advance()
-        if self._get_token(self.now_line) != ";":
-            self.compileExpression()
-        self.write_line(self.now_line)
-        self.advance()
-        self._end_non_terminal("returnStatement")
+        value = None
+        if not self._is_symbol(self.now_line, ";"):
+            value = self.compileExpression()
+        self._expect(";", "return needs ';'")
+        return ReturnStatement(value, line=line)
+
+    def compileSubroutineCall(self):
+        line = self._get_position()
+        receiver = None
+        name = self._identifier("subroutine call needs subroutineName")
+        if self._is_symbol(self.now_line, "."):
+            self.advance()
+            receiver = name
+            name = self._identifier("subroutine call needs subroutineName")
+        self._expect("(", "subroutine call needs '('")
+        arguments = self.compileExpressionList()
+        self._expect(")", "subroutine call needs ')'")
+        return SubroutineCall(receiver, name, arguments, line=line)
+
+    def compileExpressionList(self):
+        expressions = []
+        if self._is_symbol(self.now_line, ")"):
+            return expressions
+        expressions.append(self.compileExpression())
+        while self._is_symbol(self.now_line, ","):
+            self.advance()
+            expressions.append(self.compileExpression())
+        return expressions
 
     def compileExpression(self):
-        self._start_non_terminal("expression")
-        self.compileTerm()
+        # jack has no operator precedence: terms combine left to right
+        node = self.compileTerm()
         while self.is_op(self.now_line):
-            self.compileOp()
-            self.compileTerm()
-        self._end_non_terminal("expression")
-
-    def compileOp(self):
-        if self._get_token(self.now_line) not in [html.escape(x) for x in ("+", "-", "*", "/", "&", "|", "<", ">", "=")]:
-            raise CompiletaionError("{} is not supported opration".format(self._get_token(self.now_line)))
-        self.write_line(self.now_line)
-        self.advance()
+            line = self._get_position()
+            op = self._get_token(self.now_line)
+            self.advance()
+            node = BinaryOp(op, node, self.compileTerm(), line=line)
+        return node
 
     def compileTerm(self):
-        self._start_non_terminal("term")
+        line = self._get_position()
+        token = self.get_line(self.now_line)
         if self.is_unaryOp():
-            self.write_line(self.now_line)
             self.advance()
-            self.compileTerm()
-        elif self._get_tag(self.now_line) in ("integerConstant", "stringConstant", "keywordConstant"):
-            self.write_line(self.now_line)
+            return UnaryOp(token.value, self.compileTerm(), line=line)
+        elif token.kind == TokenType.INT_CONST:
             self.advance()
-        elif self._get_token(self.now_line) == "(":
-            self.write_line(self.now_line)
-            self.advance()
-            self.compileExpression()
-            self.write_line(self.now_line)
+            return IntegerConstant(token.value, line=line)
+        elif token.kind == TokenType.STRING_CONST:
             self.advance()
+            return StringConstant(token.value, line=line)
         elif self.is_keyword_constant():
-            self.write_line(self.now_line)
             self.advance()
-        else:
-            if self._get_tag(self.now_line) != "identifier":
-                raise CompilationError("{} can not use variable, subroutineName".format(self._get_tag(self.now_line)))
-            next_line = self.now_line + 1
-            next_line_content = self.get_line(next_line)
-            token = self._get_token(next_line)
-            if token == "[":
-                # varName [ expression ]
-                var_name = self._get_token(self.now_line)
-                kind = self.symbol_table.kindOf(var_name)
-                type = self.symbol_table.typeOf(var_name)
-                index = self.symbol_table.typeOf(var_name)
-                self.append_line("<identifier>used: {} {} {} {}</identifier>".format(kind, type, var_name, index))
-                self.advance()
-                self.write_line(self.now_line)
-                self.advance()
-                self.compileExpression()
-                self.write_line(self.now_line)
-                self.advance()
-            elif token in ("(", "."):
-                # subroutinecall
-                self.compileSubroutineCall()
-            else:
-                # varName
-                var_name = self._get_token(self.now_line)
-                kind = self.symbol_table.kindOf(var_name)
-                type = self.symbol_table.typeOf(var_name)
-                index = self.symbol_table.typeOf(var_name)
-                self.append_line("<identifier>used: {} {} {} {}</identifier>".format(kind, type, var_name, index))
-                self.advance()
-            
-        self._end_non_terminal("term")
+            return KeywordConstant(token.value, line=line)
+        elif token.kind == TokenType.SYMBOL and token.value == "(":
+            self.advance()
+            node = self.compileExpression()
+            self._expect(")", "expression needs ')'")
+            return node
+        if token.kind != TokenType.IDENTIFIER:
+            raise CompilationError("{} can not use variable, subroutineName".format(token.value))
+        if self._is_symbol(self.now_line + 1, "["):
+            # varName [ expression ]
+            self.advance()
+            self.advance()
+            index = self.compileExpression()
+            self._expect("]", "array access needs ']'")
+            return ArrayAccess(token.value, index, line=line)
+        elif self._is_symbol(self.now_line + 1, "(", "."):
+            return self.compileSubroutineCall()
+        self.advance()
+        return VarName(token.value, line=line)
 
     def is_unaryOp(self):
-        if self._get_token(self.now_line) in ("-", "~"):
-             return True
-        return False
+        return self._is_symbol(self.now_line, "-", "~")
 
     def is_keyword_constant(self):
-        if self._get_token(self.now_line) in ("true", "false", "null", "this"):
-             return True
-        return False
-        
-    def compileParameterList(self):
-        self._start_non_terminal("parameterList")
-        kind = "arg"
-        if self._get_tag(self.now_line) not in ("keyword", "identifier"):
-            pass
-        else:
-            self.write_line(self.now_line)
-            type = self._get_token(self.now_line)
-            self.advance()
-            if self._get_tag(self.now_line) != "identifier":
-                raise CompilationError("varName is supported 'identifier'")
-            var_name = self._get_token(self.now_line)
-            self.symbol_table.define(var_name, type, kind)
-            self.append_line("<identifier>defined: {} {} {} {}</identifier>".format(kind, type, var_name, self.symbol_table.varCount(kind)))
-            self.advance()
-            while self._get_token(self.now_line) == ",":
-                self.write_line(self.now_line)
-                self.advance()
-                self.write_line(self.now_line)
-                type = self._get_token(self.now_line)
-                self.advance()
-                var_name = self._get_token(self.now_line)
-                self.symbol_table.define(var_name, type, kind)
-                self.append_line("<identifier>defined: {} {} {} {}</identifier>".format(kind, type, var_name, self.symbol_table.varCount(kind)))
-                self.advance()
-        self._end_non_terminal("parameterList")
-
-    def _compileClassName(self):
-        tag = self._get_tag(self.now_line)
-        if tag != "identifier":
-            raise CompilationError("'class' is undefined 'className'")
-        self.write_line(self.now_line)
-        return self._get_token(self.now_line)
-        
+        return self._is_keyword(self.now_line, "true", "false", "null", "this")
 
 
 def write(wf, content):
     wf.write(content + "\n")
-       
 
-def tokenizer(files):
-    wf = None
-    tokenized_file_list = []
-    for file_path in files:
-        f = file_open(file_path)
-        tokenizer = JackTokenizer(f)
-        write_file_name = file_path.rstrip(".jack")
-        write_file_path = "{}_T.xml".format(write_file_name)
-        wf = open(write_file_path, "w")
+
+def write_tokens(tokens, write_file_path):
+    # the token stream as the book's _T.xml, for debugging
+    with open(write_file_path, "w") as wf:
         write(wf, "<tokens>")
-        while True:
-            tokenType = tokenizer.tokenType()
-            token = None
-            if tokenType == TokenType.KEYWORD:
-                token = tokenizer.keyword()
-            elif tokenType == TokenType.INT_CONST:
-                token = int(tokenizer.token)
-            elif tokenType == TokenType.STRING_CONST:
-                token = tokenizer.token.strip("\"")
-            elif tokenType in (TokenType.SYMBOL, TokenType.IDENTIFIER):
-                token = tokenizer.token   
-            else:
-                raise TokenizeError("cant parse token {}".format(tokenizer.token))
-            tokenizer.write_token(token, tokenType, wf)
-            #tokenizer.compile_token(token, tokenType)
+        wf.writelines(token_xml(token) for token in tokens)
+        write(wf, "</tokens>")
 
-            if not tokenizer.hasMoreTokens():
-                break
 
-            tokenizer.advance()
-        write(wf, "</tokens>")
-        wf.close()
-        tokenized_file_list.append(write_file_path)
-    return tokenized_file_list
+def tokenize(file_path):
+    with file_open(file_path) as f:
+        return JackTokenizer(f).tokens
+
+
+def ast_xml(node, field=None, indent=""):
+    # a readable dump of the AST, for debugging
+    if isinstance(node, Node):
+        tag = type(node).__name__
+        attributes = " field=\"{}\"".format(field) if field else ""
+        lines = ["{}<{}{} line=\"{}\">\n".format(indent, tag, attributes, node.line)]
+        for name, value in node.fields():
+            lines.extend(ast_xml(value, name, indent + "  "))
+        lines.append("{}</{}>\n".format(indent, tag))
+        return lines
+    tag = field or "item"
+    if isinstance(node, (list, tuple)):
+        lines = ["{}<{}>\n".format(indent, tag)]
+        for value in node:
+            lines.extend(ast_xml(value, None, indent + "  "))
+        lines.append("{}</{}>\n".format(indent, tag))
+        return lines
+    return ["{}<{}> {} </{}>\n".format(indent, tag, html.escape(str(node)), tag)]
+
+
+def parse(tokens):
+    return CompilationEngine(tokens).compile()
+
+
+def compilate(file_path, class_node):
+    # class_node to <file>.vm
+    writer = VMWriter(os.path.splitext(file_path)[0])
+    generator = CodeGenerator(writer)
+    generator.write_class(class_node)
+    writer.close()
+    return generator
+
+
+def source_hash(file_path):
+    with open(file_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def compile_file(file_path, options):
+    # one .jack file to .vm; also the process pool worker, so errors come
+    # back as a diagnostic string instead of being raised. entry is what
+    # the manifest keeps for the file, None if it failed
+    start = time.perf_counter()
+    write_file_name = os.path.splitext(file_path)[0]
+    entry = None
+    try:
+        source = source_hash(file_path)
+        tokens = tokenize(file_path)
+        if "--tokens" in options:
+            write_tokens(tokens, "{}_T.xml".format(write_file_name))
+        class_node = parse(tokens)
+        if "--xml" in options:
+            # not <name>.xml: that is the book's parse tree the projects compare against
+            with open("{}_AST.xml".format(write_file_name), "w") as wf:
+                wf.writelines(ast_xml(class_node))
+        generator = compilate(file_path, class_node)
+        entry = {"hash": source, "functions": generator.functions, "calls": generator.calls}
+        diagnostic = None
+    except (TokenizeError, CompilationError, CodeGenerationError, FileParseError, OSError, UnicodeDecodeError) as e:
+        diagnostic = "{}: {}".format(file_path, e)
+    return diagnostic, time.perf_counter() - start, entry
+
+
+def compile_files(files, options):
+    # results are in the order of files, whichever worker finishes first
+    if "--parallel" in options and len(files) > 1:
+        jobs = int(get_option_value(options, "--jobs", 0)) or None
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(compile_file, files, [options] * len(files)))
+    return [compile_file(file_path, options) for file_path in files]
+
+
+def get_manifest_path(path):
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def load_manifest(manifest_path, options):
+    # entries are keyed by file name, as the manifest sits next to the
+    # sources. a manifest written with other output options can not be reused
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("options") != build_options(options):
+        return {}
+    return manifest.get("files", {})
+
+
+def save_manifest(manifest_path, options, files):
+    with open(manifest_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "options": build_options(options), "files": files}, f,
+                sort_keys=True)
+
+
+def build_options(options):
+    return sorted(option for option in options if option in ("--tokens", "--xml"))
+
+
+def is_up_to_date(file_path, entry):
+    if entry is None or not os.path.exists("{}.vm".format(os.path.splitext(file_path)[0])):
+        return False
+    try:
+        return entry["hash"] == source_hash(file_path)
+    except OSError:
+        # compile_file reports it
+        return False
 
 
-def compilate(files):
+def changed_functions(old_entries, new_entries):
+    # names whose argument count changed, appeared or disappeared
+    old_functions = {}
+    new_functions = {}
+    for entries, functions in ((old_entries, old_functions), (new_entries, new_functions)):
+        for entry in entries:
+            if entry is not None:
+                functions.update(entry["functions"])
+    return {name for name in set(old_functions) | set(new_functions)
+            if old_functions.get(name) != new_functions.get(name)}
+
+
+def merge_entries(manifest_path, old_entries, files, entries):
+    # this build's entries over the ones of other classes in the directory
+    # that still exist, so compiling one file keeps the rest of the manifest
+    directory = os.path.dirname(manifest_path)
+    built = {os.path.basename(file_path) for file_path in files}
+    merged = {name: entry for name, entry in old_entries.items()
+            if name not in built and os.path.exists(os.path.join(directory, name))}
+    merged.update((os.path.basename(file_path), entry) for file_path, entry in entries.items())
+    return merged
+
+
+def check_calls(files, entries, known_entries):
+    # calls into known classes must match the callee's argument count;
+    # calls into other classes (the OS) are not checked
+    functions = {}
+    for entry in known_entries:
+        functions.update(entry["functions"])
+    class_names = {name.split(".")[0] for name in functions}
+    diagnostics = []
     for file_path in files:
-        compile_engine = CompilationEngine(file_path)
-        write_file_name = file_path.rstrip(".xml")
-        compile_engine.compile()
-        compile_engine.write()
-        compile_engine.close()
+        if file_path not in entries:
+            continue
+        class_name = os.path.splitext(os.path.basename(file_path))[0]
+        for name, args, line in entries[file_path]["calls"]:
+            if name.split(".")[0] not in class_names:
+                continue
+            if name not in functions:
+                diagnostics.append("{}: {}:{}: {} is not defined".format(file_path, class_name, line, name))
+            elif functions[name] != args:
+                diagnostics.append("{}: {}:{}: {} takes {} arguments, called with {}".format(
+                    file_path, class_name, line, name, functions[name], args))
+    return diagnostics
+
+
+def build(files, options, manifest_path=None):
+    # compiles files and returns (diagnostics, timings). with a manifest
+    # only changed classes are compiled, plus the classes calling a
+    # subroutine whose signature changed
+    old_entries = load_manifest(manifest_path, options) if manifest_path else {}
+    entries = {file_path: old_entries[os.path.basename(file_path)] for file_path in files
+            if os.path.basename(file_path) in old_entries}
+    if manifest_path:
+        targets = [file_path for file_path in files if not is_up_to_date(file_path, entries.get(file_path))]
+    else:
+        targets = files
+    diagnostics = []
+    timings = []
+    while targets:
+        results = compile_files(targets, options)
+        changed = changed_functions([entries.get(file_path) for file_path in targets],
+                [entry for diagnostic, elapsed, entry in results])
+        for file_path, (diagnostic, elapsed, entry) in zip(targets, results):
+            timings.append((file_path, elapsed))
+            if diagnostic:
+                diagnostics.append(diagnostic)
+                entries.pop(file_path, None)
+            else:
+                entries[file_path] = entry
+        compiled = {file_path for file_path, elapsed in timings}
+        targets = [file_path for file_path in files if file_path in entries and file_path not in compiled
+                and any(name in changed for name, args, line in entries[file_path]["calls"])]
+
+    if manifest_path:
+        merged = merge_entries(manifest_path, old_entries, files, entries)
+        save_manifest(manifest_path, options, merged)
+        diagnostics.extend(check_calls(files, entries, merged.values()))
+    else:
+        diagnostics.extend(check_calls(files, entries, entries.values()))
+    return diagnostics, sorted(timings)
+
 
 def main():
     files = get_files()
     if not files:
         raise FileNotExistError("not passed target files")
-    tokenized_file_list = tokenizer(files)
-    compilate(tokenized_file_list)
+    options = get_options()
+    manifest_path = get_manifest_path(sys.argv[1]) if "--incremental" in options else None
+    start = time.perf_counter()
+    diagnostics, timings = build(files, options, manifest_path)
+    elapsed = time.perf_counter() - start
+
+    if "--time" in options:
+        for file_path, file_elapsed in timings:
+            print("    {:<40} {:.3f}s".format(os.path.basename(file_path), file_elapsed))
+        print("{} of {} files compiled in {:.3f}s".format(len(timings), len(files), elapsed))
+    for diagnostic in diagnostics:
+        print(diagnostic, file=sys.stderr)
+    if diagnostics:
+        sys.exit(1)
 
 
 def get_files():
@@ -767,7 +758,17 @@ def get_files():
     else:
         files.append(path)
     
-    return files
+    # a stable order keeps diagnostics and timings identical between runs
+    return sorted(files)
+
+def get_options():
+    return [v for v in sys.argv[2:] if v.startswith("--")]
+
+def get_option_value(options, name, default):
+    for option in options:
+        if option.startswith(name + "="):
+            return option.split("=", 1)[1]
+    return default
 
 def file_open(file_path):
     splited_file_name = file_path.split(".")
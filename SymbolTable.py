@@ -5,13 +5,10 @@ class SymbolTableError(Exception):
 class SymbolTable(object):
     def __init__(self):
         self.class_table = {}
-        self.class_index = 0
         self.subroutine_table = {}
-        self.subroutine_index = 0
 
     def startSubroutine(self):
         self.subroutine_table = {}
-        self.subroutine_index = 0
 
     def is_class_table(self, kind):
         if kind in ("static", "field"):
@@ -24,12 +21,11 @@ class SymbolTable(object):
         return False
 
     def define(self, name, type, kind):
+        # indexes count per kind: static and field, arg and var are separate segments
         if self.is_class_table(kind):
-            self.class_table[name] = {"type": type, "kind": kind, "index": self.class_index}
-            self.class_index += 1
+            self.class_table[name] = {"type": type, "kind": kind, "index": self.varCount(kind)}
         elif self.is_subroutine_table(kind):
-            self.subroutine_table[name] = {"type": type, "kind": kind, "index": self.subroutine_index}
-            self.subroutine_index += 1
+            self.subroutine_table[name] = {"type": type, "kind": kind, "index": self.varCount(kind)}
         else:
             raise SymbolTableError("{} cant use as kind".format(kind))
 
@@ -0,0 +1,42 @@
+import io
+
+
+class VMWriter(object):
+    def __init__(self, name):
+        # without a name the vm code is kept in memory and returned by close()
+        self.file = open("{}.vm".format(name), "w") if name else io.StringIO()
+        self.name = name
+        self.lines = []
+
+    def writePush(self, segment, index):
+        self.lines.append("push {} {}".format(segment, index))
+
+    def writePop(self, segment, index):
+        self.lines.append("pop {} {}".format(segment, index))
+
+    def writeArithmetic(self, command):
+        self.lines.append(command)
+
+    def writeLabel(self, label):
+        self.lines.append("label {}".format(label))
+
+    def writeGoto(self, label):
+        self.lines.append("goto {}".format(label))
+
+    def writeIf(self, label):
+        self.lines.append("if-goto {}".format(label))
+
+    def writeCall(self, name, nArgs):
+        self.lines.append("call {} {}".format(name, nArgs))
+
+    def writeFunction(self, name, nLocals):
+        self.lines.append("function {} {}".format(name, nLocals))
+
+    def writeReturn(self):
+        self.lines.append("return")
+
+    def close(self):
+        self.file.write("\n".join(self.lines) + "\n")
+        value = self.file.getvalue() if self.name is None else None
+        self.file.close()
+        return value
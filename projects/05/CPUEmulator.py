@@ -0,0 +1,383 @@
+import os
+import re
+import sys
+import time
+from array import array
+
+
+class EmulatorError(Exception):
+    pass
+
+RAM_SIZE = 32768
+ROM_SIZE = 32768
+SCREEN = 16384
+SCREEN_WIDTH = 512
+SCREEN_HEIGHT = 256
+SCREEN_WORDS = SCREEN_WIDTH // 16 * SCREEN_HEIGHT
+KBD = 24576
+DEFAULT_STEPS = 10000000
+# 0;JMP, the jump half of the @X / 0;JMP loop programs end with
+HALT_WORD = 0xEA87
+# longest straight-line run compiled into one block
+BLOCK_LIMIT = 1024
+
+
+def wrap(value):
+    # 16 bit two's complement, as stored in array('h')
+    return ((value + 32768) & 0xFFFF) - 32768
+
+
+def alu(x, y, control):
+    # the generic Hack ALU for comp codes outside the documented table
+    if control & 0x20:
+        x = 0
+    if control & 0x10:
+        x = ~x
+    if control & 0x08:
+        y = 0
+    if control & 0x04:
+        y = ~y
+    out = x + y if control & 0x02 else x & y
+    if control & 0x01:
+        out = ~out
+    return wrap(out)
+
+
+def comp_functions(ram):
+    # comp code (a bit and c1..c6) -> function of (A, D); RAM holds exactly
+    # 32K words, so a negative A indexes the same word as A & 0x7FFF
+    comps = {
+        0b0101010: lambda A, D: 0,
+        0b0111111: lambda A, D: 1,
+        0b0111010: lambda A, D: -1,
+        0b0001100: lambda A, D: D,
+        0b0110000: lambda A, D: A,
+        0b1110000: lambda A, D: ram[A],
+        0b0001101: lambda A, D: ~D,
+        0b0110001: lambda A, D: ~A,
+        0b1110001: lambda A, D: ~ram[A],
+        0b0001111: lambda A, D: -D if D != -32768 else D,
+        0b0110011: lambda A, D: -A if A != -32768 else A,
+        0b1110011: lambda A, D: wrap(-ram[A]),
+        0b0011111: lambda A, D: D + 1 if D != 32767 else -32768,
+        0b0110111: lambda A, D: A + 1 if A != 32767 else -32768,
+        0b1110111: lambda A, D: wrap(ram[A] + 1),
+        0b0001110: lambda A, D: D - 1 if D != -32768 else 32767,
+        0b0110010: lambda A, D: A - 1 if A != -32768 else 32767,
+        0b1110010: lambda A, D: wrap(ram[A] - 1),
+        0b0000010: lambda A, D: ((D + A + 32768) & 0xFFFF) - 32768,
+        0b1000010: lambda A, D: ((D + ram[A] + 32768) & 0xFFFF) - 32768,
+        0b0010011: lambda A, D: ((D - A + 32768) & 0xFFFF) - 32768,
+        0b1010011: lambda A, D: ((D - ram[A] + 32768) & 0xFFFF) - 32768,
+        0b0000111: lambda A, D: ((A - D + 32768) & 0xFFFF) - 32768,
+        0b1000111: lambda A, D: ((ram[A] - D + 32768) & 0xFFFF) - 32768,
+        0b0000000: lambda A, D: D & A,
+        0b1000000: lambda A, D: D & ram[A],
+        0b0010101: lambda A, D: D | A,
+        0b1010101: lambda A, D: D | ram[A],
+    }
+    for code in range(128):
+        if code not in comps:
+            control = code & 0x3F
+            if code & 0x40:
+                comps[code] = lambda A, D, control=control: alu(D, ram[A], control)
+            else:
+                comps[code] = lambda A, D, control=control: alu(D, A, control)
+    return comps
+
+
+WRAP = "((({}) + 32768) & 0xFFFF) - 32768"
+
+# comp code -> python expression over A, D and ram, for the block compiler
+COMP_SOURCES = {
+    0b0101010: "0",
+    0b0111111: "1",
+    0b0111010: "-1",
+    0b0001100: "D",
+    0b0110000: "A",
+    0b1110000: "ram[A]",
+    0b0001101: "~D",
+    0b0110001: "~A",
+    0b1110001: "~ram[A]",
+    0b0001111: WRAP.format("-D"),
+    0b0110011: WRAP.format("-A"),
+    0b1110011: WRAP.format("-ram[A]"),
+    0b0011111: WRAP.format("D + 1"),
+    0b0110111: WRAP.format("A + 1"),
+    0b1110111: WRAP.format("ram[A] + 1"),
+    0b0001110: WRAP.format("D - 1"),
+    0b0110010: WRAP.format("A - 1"),
+    0b1110010: WRAP.format("ram[A] - 1"),
+    0b0000010: WRAP.format("D + A"),
+    0b1000010: WRAP.format("D + ram[A]"),
+    0b0010011: WRAP.format("D - A"),
+    0b1010011: WRAP.format("D - ram[A]"),
+    0b0000111: WRAP.format("A - D"),
+    0b1000111: WRAP.format("ram[A] - D"),
+    0b0000000: "D & A",
+    0b1000000: "D & ram[A]",
+    0b0010101: "D | A",
+    0b1010101: "D | ram[A]",
+}
+
+JUMP_SOURCES = {
+    1: "t > 0",
+    2: "t == 0",
+    3: "t >= 0",
+    4: "t < 0",
+    5: "t != 0",
+    6: "t <= 0",
+}
+
+
+def comp_source(code):
+    if code in COMP_SOURCES:
+        return COMP_SOURCES[code]
+    return "alu(D, {}, {})".format("ram[A]" if code & 0x40 else "A", code & 0x3F)
+
+
+def block_source(rom, start, end):
+    # python source of a function running rom[start:end] and returning
+    # (A, D, next pc); only the last instruction may jump. While A holds an
+    # @value it is substituted as a constant and only stored on return
+    lines = ["def block(A, D, ram=ram, alu=alu):"]
+    next_pc = end
+    a = "A"
+    for word in rom[start:end]:
+        if not word & 0x8000:
+            a = str(word)
+            continue
+        comp = re.sub(r"\bA\b", a, comp_source((word >> 6) & 0x7F))
+        dest = (word >> 3) & 7
+        jump = word & 7
+        target = "{} & 0x7FFF".format(a) if a == "A" else str(int(a) & 0x7FFF)
+        if jump and a == "A" and dest & 4:
+            # the jump goes to A as it was before this instruction
+            lines.append("    a = A")
+            target = "a & 0x7FFF"
+        if dest in (1, 2, 4) and not jump:
+            lines.append("    {} = {}".format({1: "ram[{}]".format(a), 2: "D", 4: "A"}[dest], comp))
+            if dest == 4:
+                a = "A"
+            continue
+        lines.append("    t = {}".format(comp))
+        if dest & 1:
+            lines.append("    ram[{}] = t".format(a))
+        if dest & 4:
+            lines.append("    A = t")
+            a = "A"
+        if dest & 2:
+            lines.append("    D = t")
+        if jump == 7:
+            lines.append("    return {}, D, {}".format(a, target))
+            return "\n".join(lines)
+        elif jump:
+            lines.append("    return {}, D, ({}) if {} else {}".format(a, target, JUMP_SOURCES[jump], next_pc))
+            return "\n".join(lines)
+    lines.append("    return {}, D, {}".format(a, next_pc))
+    return "\n".join(lines)
+
+
+def load_rom(path):
+    # .hack text, with or without the assembler's spaces, or a little-endian .bin image
+    if os.path.splitext(path)[1] == ".bin":
+        words = array("H")
+        with open(path, "rb") as f:
+            words.frombytes(f.read())
+        if sys.byteorder == "big":
+            words.byteswap()
+        return list(words)
+    words = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.replace(" ", "").strip()
+            if line:
+                words.append(int(line, 2))
+    return words
+
+
+class CPUEmulator(object):
+    def __init__(self, rom, jit=False):
+        if len(rom) > ROM_SIZE:
+            raise EmulatorError("rom has {} words, more than 32K".format(len(rom)))
+        self.rom = rom
+        # RAM, SCREEN and KBD in one 32K address space of 16 bit words
+        self.ram = array("h", bytes(2 * RAM_SIZE))
+        self.code = self.decode(rom)
+        # jit mode: compiled basic blocks by start address, (function, length);
+        # None marks an address the interpreter has to run
+        self.jit = jit
+        self.blocks = {}
+        self.leaders = self.find_leaders(rom)
+        self.A = 0
+        self.D = 0
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+
+    def decode(self, rom):
+        # each word is decoded once: an A instruction becomes its value, a C
+        # instruction a (comp function, dest bits, jump bits) tuple, and the
+        # 0;JMP of an @X / 0;JMP loop onto itself becomes None, which halts
+        comps = comp_functions(self.ram)
+        code = []
+        for pc, word in enumerate(rom):
+            if not word & 0x8000:
+                code.append(word)
+            elif word == HALT_WORD and pc > 0 and rom[pc - 1] == pc - 1:
+                code.append(None)
+            else:
+                code.append((comps[(word >> 6) & 0x7F], (word >> 3) & 7, word & 7))
+        return code
+
+    def find_leaders(self, rom):
+        # block starts: the targets of @X / jump pairs and the instruction after every jump
+        leaders = set([0])
+        for pc, word in enumerate(rom):
+            if word & 0x8000 and word & 7:
+                leaders.add(pc + 1)
+                if pc > 0 and not rom[pc - 1] & 0x8000:
+                    leaders.add(rom[pc - 1])
+        return leaders
+
+    def compile_block(self, start):
+        end = start
+        while end < len(self.rom) and end - start < BLOCK_LIMIT and self.code[end] is not None:
+            end += 1
+            if self.rom[end - 1] & 0x8000 and self.rom[end - 1] & 7 or end in self.leaders:
+                break
+        if end == start:
+            return None
+        namespace = {"ram": self.ram, "alu": alu}
+        exec(compile(block_source(self.rom, start, end), "<block {}>".format(start), "exec"), namespace)
+        return namespace["block"], end - start
+
+    def reset(self):
+        self.pc = 0
+        self.halted = False
+
+    def run(self, max_steps=DEFAULT_STEPS):
+        if self.jit:
+            return self.run_blocks(max_steps)
+        return self.interpret(max_steps)
+
+    def run_blocks(self, max_steps):
+        # whole blocks while they fit in max_steps; the halt loop, the end of
+        # the rom and the last few steps go to the interpreter
+        blocks = self.blocks
+        A = self.A
+        D = self.D
+        pc = self.pc
+        end = len(self.code)
+        steps = 0
+        while 0 <= pc < end:
+            if pc in blocks:
+                block = blocks[pc]
+            else:
+                block = blocks[pc] = self.compile_block(pc)
+            if block is None or steps + block[1] > max_steps:
+                break
+            A, D, pc = block[0](A, D)
+            steps += block[1]
+        self.A = A
+        self.D = D
+        self.pc = pc
+        self.steps += steps
+        if steps < max_steps and 0 <= pc < end:
+            steps += self.interpret(max_steps - steps)
+        return steps
+
+    def interpret(self, max_steps):
+        code = self.code
+        ram = self.ram
+        A = self.A
+        D = self.D
+        pc = self.pc
+        end = len(code)
+        steps = 0
+        while steps < max_steps and pc < end:
+            instruction = code[pc]
+            steps += 1
+            if instruction.__class__ is int:
+                A = instruction
+                pc += 1
+                continue
+            if instruction is None:
+                self.halted = True
+                steps -= 1
+                break
+            comp, dest, jump = instruction
+            out = comp(A, D)
+            address = A
+            if dest:
+                if dest & 1:
+                    ram[A] = out
+                if dest & 4:
+                    A = out
+                if dest & 2:
+                    D = out
+            if jump and (jump == 7 or (jump & 4 and out < 0) or (jump & 2 and out == 0) or (jump & 1 and out > 0)):
+                pc = address & 0x7FFF
+            else:
+                pc += 1
+        self.A = A
+        self.D = D
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+    def set_key(self, key):
+        self.ram[KBD] = key
+
+    def screen(self):
+        return self.ram[SCREEN:SCREEN + SCREEN_WORDS]
+
+    def write_screen(self, path):
+        # the screen as a plain PBM image; bit 0 of a word is its leftmost pixel
+        words = self.screen()
+        with open(path, "w") as f:
+            f.write("P1\n{} {}\n".format(SCREEN_WIDTH, SCREEN_HEIGHT))
+            for row in range(SCREEN_HEIGHT):
+                pixels = []
+                for word in words[row * 32:(row + 1) * 32]:
+                    pixels.extend("1" if word >> bit & 1 else "0" for bit in range(16))
+                f.write(" ".join(pixels) + "\n")
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise EmulatorError("not passed target file")
+    options = get_options()
+    emulator = CPUEmulator(load_rom(sys.argv[1]), "--jit" in options)
+    # --set=ADDRESS:VALUE, repeatable
+    for option in options:
+        if option.startswith("--set="):
+            address, value = option.split("=", 1)[1].split(":")
+            emulator.ram[int(address)] = wrap(int(value))
+    emulator.set_key(int(get_option_value(options, "--key", 0)))
+
+    start = time.perf_counter()
+    steps = emulator.run(int(get_option_value(options, "--steps", DEFAULT_STEPS)))
+    elapsed = time.perf_counter() - start
+    print("{} instructions in {:.3f}s ({:,.0f} instructions/s){}".format(
+            steps, elapsed, steps / elapsed if elapsed > 0 else 0, ", halted" if emulator.halted else ""))
+
+    addresses = get_option_value(options, "--ram", "")
+    for address in addresses.split(","):
+        if address:
+            print("RAM[{}] = {}".format(address, emulator.ram[int(address)]))
+    screen = get_option_value(options, "--screen", None)
+    if screen:
+        emulator.write_screen(screen)
+
+def get_options():
+    return [v for v in sys.argv[2:] if v.startswith("--")]
+
+def get_option_value(options, name, default):
+    for option in options:
+        if option.startswith(name + "="):
+            return option.split("=", 1)[1]
+    return default
+
+if __name__ == "__main__":
+    main()
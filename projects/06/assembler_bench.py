@@ -0,0 +1,161 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from hack_assembler import Parser, SymbolTable, first_pass, second_pass, write_hack, get_options, get_option_value
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CORPUS = [
+    "add/Add.asm",
+    "max/Max.asm",
+    "max/MaxL.asm",
+    "rect/Rect.asm",
+    "rect/RectL.asm",
+    "pong/Pong.asm",
+    "pong/PongL.asm",
+]
+
+STAGES = ["parser", "first_pass", "second_pass", "write"]
+
+DEFAULT_SYNTHETIC_LINES = 1000000
+SYNTHETIC_LABELS = 2048
+
+
+def synthetic_source(line_count):
+    # labelled blocks with forward jumps and a rotating set of variables;
+    # jump targets wrap so every label address stays inside the 32K ROM
+    lines = []
+    block = 0
+    while len(lines) < line_count:
+        if block < SYNTHETIC_LABELS:
+            lines.append("(BLOCK{})".format(block))
+        lines.append("@var{}".format(block % 64))
+        lines.append("D=M")
+        lines.append("@{}".format(block % 32768))
+        lines.append("D=D+A")
+        lines.append("@SP")
+        lines.append("AM=M+1")
+        lines.append("A=A-1")
+        lines.append("M=D")
+        lines.append("@BLOCK{}".format((block + 1) % SYNTHETIC_LABELS))
+        lines.append("D;JGT")
+        lines.append("// filler comment")
+        lines.append("@R13")
+        lines.append("M=D")
+        lines.append("@var{}".format((block + 7) % 64))
+        lines.append("0;JMP")
+        block += 1
+    lines = lines[:line_count]
+    return "\n".join(lines) + "\n"
+
+
+def run_stages(source):
+    # returns (instruction count, {stage: seconds})
+    timings = {}
+    start = time.perf_counter()
+    parser = Parser(io.StringIO(source))
+    timings["parser"] = time.perf_counter() - start
+
+    symbol_table = SymbolTable()
+    start = time.perf_counter()
+    first_pass(parser.instructions, symbol_table)
+    timings["first_pass"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    words = second_pass(parser.instructions, symbol_table)
+    timings["second_pass"] = time.perf_counter() - start
+
+    with tempfile.TemporaryFile("w") as f:
+        start = time.perf_counter()
+        write_hack(words, f)
+        f.flush()
+        timings["write"] = time.perf_counter() - start
+
+    return len(words), timings
+
+
+def run_peak_memory(source):
+    # a second run under tracemalloc, which is too slow to time against
+    peaks = {}
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        parser = Parser(io.StringIO(source))
+        peaks["parser"] = tracemalloc.get_traced_memory()[1]
+
+        symbol_table = SymbolTable()
+        tracemalloc.reset_peak()
+        first_pass(parser.instructions, symbol_table)
+        peaks["first_pass"] = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        words = second_pass(parser.instructions, symbol_table)
+        peaks["second_pass"] = tracemalloc.get_traced_memory()[1]
+
+        with tempfile.TemporaryFile("w") as f:
+            tracemalloc.reset_peak()
+            write_hack(words, f)
+            f.flush()
+            peaks["write"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def bench(name, source, repeat):
+    best = {}
+    count = 0
+    for i in range(repeat):
+        count, timings = run_stages(source)
+        for stage, seconds in timings.items():
+            best[stage] = min(best.get(stage, seconds), seconds)
+    peaks = run_peak_memory(source)
+
+    result = {"name": name, "instructions": count, "stages": {}}
+    for stage in STAGES:
+        seconds = best[stage]
+        result["stages"][stage] = {
+            "seconds": seconds,
+            "instructions_per_second": count / seconds if seconds > 0 else None,
+            "peak_memory_bytes": peaks[stage],
+        }
+    return result
+
+
+def print_result(result):
+    print("{} ({} instructions)".format(result["name"], result["instructions"]))
+    for stage in STAGES:
+        r = result["stages"][stage]
+        ips = r["instructions_per_second"]
+        print("    {:<12} {:>10.4f}s {:>14} ins/s {:>12} bytes peak".format(
+                stage, r["seconds"], "-" if ips is None else "{:,.0f}".format(ips), r["peak_memory_bytes"]))
+
+
+def main():
+    options = get_options()
+    repeat = int(get_option_value(options, "--repeat", 3))
+    synthetic_lines = int(get_option_value(options, "--synthetic-lines", DEFAULT_SYNTHETIC_LINES))
+    output = get_option_value(options, "--output", "bench_output.json")
+
+    results = []
+    for path in CORPUS:
+        with open(os.path.join(BASE_DIR, path), "r") as f:
+            source = f.read()
+        results.append(bench(path, source, repeat))
+        print_result(results[-1])
+    if synthetic_lines > 0:
+        results.append(bench("synthetic-{}".format(synthetic_lines), synthetic_source(synthetic_lines), 1))
+        print_result(results[-1])
+
+    with open(output, "w") as f:
+        json.dump({"python": sys.version, "repeat": repeat, "results": results}, f, indent=2)
+    print("saved {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,15 @@
+import glob
+import hashlib
+import io
+import itertools
+import mmap
+import os
+import shutil
 import sys
+import time
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 class CommandType(Enum):
@@ -23,6 +34,55 @@ class CodeValidationError(Exception):
     pass
 
 
+# one parsed source line; kind is a CommandType, line is the 1-based source line
+Instruction = namedtuple("Instruction", ["kind", "symbol", "dest", "comp", "jump", "line"])
+
+
+def normalize(command):
+    command = command.replace(" ", "")
+    return command.split("//")[0].strip()
+
+
+def parse_line(source_line, line):
+    command = normalize(source_line)
+    if not command:
+        return None
+
+    if command[0] == "@":
+        return Instruction(CommandType.A_COMMAND, command[1:], None, None, None, line)
+
+    dest = None
+    jump = None
+    comp = command
+    if "=" in comp:
+        dest, comp = comp.split("=", 1)
+        if dest not in DEST_TABLE:
+            return parse_l_command(command, line)
+    if ";" in comp:
+        comp, jump = comp.split(";", 1)
+        if jump not in JUMP_TABLE:
+            return parse_l_command(command, line)
+    if (dest or jump) and comp in COMP_TABLE:
+        return Instruction(CommandType.C_COMMAND, None, dest, comp, jump, line)
+
+    return parse_l_command(command, line)
+
+
+def parse_l_command(command, line):
+    if command[0] == "(" and command[-1] == ")":
+        return Instruction(CommandType.L_COMMAND, command[1:-1], None, None, None, line)
+
+    return None
+
+
+def iter_instructions(file_):
+    # parse an open asm file lazily, one line at a time
+    for i, source_line in enumerate(file_):
+        instruction = parse_line(source_line, i + 1)
+        if instruction is not None:
+            yield instruction
+
+
 class Parser(object):
     def __init__(self, file_):
         self.lines = []
@@ -30,6 +90,8 @@ class Parser(object):
             self.lines.append(line)
 
         self.line_sum = len(self.lines)
+        self.parsed = [parse_line(line, i + 1) for i, line in enumerate(self.lines)]
+        self.instructions = [x for x in self.parsed if x is not None]
         self.now_line = 0
         self.set_command()
 
@@ -38,14 +100,14 @@ class Parser(object):
         self.set_command()
 
     def normalize(self, command):
-        command = command.replace(" ", "")
-        return command.split("//")[0]
+        return normalize(command)
 
     def hasMoreCommands(self):
         return self.now_line < self.line_sum - 1
 
     def set_command(self):
         self.command = self.normalize(self.lines[self.now_line]).strip()
+        self.instruction = self.parsed[self.now_line]
 
     def advance(self):
         if self.hasMoreCommands():
@@ -53,56 +115,17 @@ class Parser(object):
             self.set_command()
 
     def commandType(self):
-        if not self.command:
+        if self.instruction is None:
             return None
 
-        if self.check_is_a_command():
-            return CommandType.A_COMMAND
-        elif self.check_is_c_command():
-            return CommandType.C_COMMAND
-        elif self.check_is_l_command():
-            return CommandType.L_COMMAND
-
-    def check_is_a_command(self):
-        if self.command[0] == "@":
-            return True
-
-    def check_is_c_command(self):
-        split_equal = self.command.split("=")
-        split_semi_colon = self.command.split(";")
-        comp = ""
-        if len(split_equal) > 1:
-            dest = split_equal[0]
-            if dest not in ("M", "D", "MD", "A", "AM", "AD", "AMD"):
-                return False
-
-            comp = split_equal[1]
-        elif len(split_semi_colon) > 1:
-            jump = split_semi_colon[1]
-            if jump not in ("JGT", "JEQ", "JGE", "JLT", "JNE", "JLE", "JMP"):
-                return False
-
-            comp = split_semi_colon[0]
-        else:
-            return False
-
-        if len(comp) > 0:
-            comp = comp.strip()
-        if comp in ("0", "1", "-1", "D", "A", "!D", "!A", "-D", "-A", "D+1", "A+1", "D-1", "D+A", "D-A", "A-D", "D&A", "D|A",
-                "M", "!M", "-M", "M+1", "M-1", "D+M", "D-M", "M-D", "D&M", "D|M"):
-            return True
-
-        return False
-
-    def check_is_l_command(self):
-        return self.command[0] == "(" and self.command[-1] == ")"
+        return self.instruction.kind
 
     def l_command(self):
-        return self.command[1:-1]
+        return self.instruction.symbol
 
     def symbol(self):
         if self.commandType() == CommandType.A_COMMAND:
-            return self.command.split("@")[1]
+            return self.instruction.symbol
         elif self.commandType() == CommandType.L_COMMAND:
             return self.command
         else:
@@ -111,164 +134,93 @@ class Parser(object):
     def dest(self):
         if self.commandType() != CommandType.C_COMMAND:
             raise NotCOperation("C?????????????????g?B????????")
-        split_equal = self.command.split("=")
-        if len(split_equal) > 1:
-            dest = split_equal[0]
-            if dest not in ("M", "D", "MD", "A", "AM", "AD", "AMD"):
-                raise NotValidOperation("dest????????????`?????B???????")
-
-            return dest
-
-        else:
-            return None
+        return self.instruction.dest
 
     def comp(self):
         if self.commandType() != CommandType.C_COMMAND:
             raise NotCOperation("C?????????????????g?B????????")
-        split_equal = self.command.split("=")
-        split_semi_colon = None
-        comp = None
-        if len(split_equal) > 1:
-            split_semi_colon = split_equal[1].split(";")
-        else:
-            split_semi_colon = self.command.split(";")
-
-        comp = split_semi_colon[0].strip()
-        if comp not in ("0", "1", "-1", "D", "A", "!D", "!A", "-D", "-A", "D+1", "A+1", "D-1", "D+A", "D-A", "A-D", "D&A", "D|A",
-                "M", "!M", "-M", "M+1", "M-1", "D+M", "D-M", "M-D", "D&M", "D|M"):
-            return None
-
-        return comp
+        return self.instruction.comp
 
     def jump(self):
         if self.commandType() != CommandType.C_COMMAND:
             raise NotCOperation("C?????????????????g?B????????")
-        split_semi_colon = self.command.split(";")
-        if 1 >= len(split_semi_colon):
-            return None
-
-        jump = split_semi_colon[1]
-        return jump
-            
-
-class Code(object):
-    def __init__(self, dest, comp, jump):
-        self.dest_ = dest
-        self.comp_ = comp
-        self.jump_ = jump
-
-    def dest(self):
-        if not self.dest_:
-            return "000"
-        
-        dest = self.dest_
-        if dest == "M":
-            return "001"
-        elif dest == "D":
-            return "010"
-        elif dest == "MD":
-            return "011"
-        elif dest == "A":
-            return "100"
-        elif dest == "AM":
-            return "101"
-        elif dest == "AD":
-            return "110"
-        elif dest == "AMD":
-            return "111"
-
-    def comp(self):
-        if not self.comp_:
-            return None
-
-        comp = self.comp_
-        if comp == "0":
-            return "0101010"
-        elif comp == "1":
-            return "0111111"
-        elif comp == "-1":
-            return "0111010"
-        elif comp == "D":
-            return "0001100"
-        elif comp in ("A", "M"):
-            if comp == "A":
-                return "0110000"
-            else:
-                return "1110000"
-        elif comp == "!D":
-            return "0001101"
-        elif comp in ("!A", "!M"):
-            if comp == "!A":
-                return "0110001"
-            else:
-                return "1110001"
-        elif comp == "-D":
-            return "0001111"
-        elif comp in ("-A", "-M"):
-            if comp == "-A":
-                return "0110011"
-            else:
-                return "1110011"
-        elif comp == "D+1":
-            return "0011111"
-        elif comp in ("A+1", "M+1"):
-            if comp == "A+1":
-                return "0110111"
-            else:
-                return "1110111"
-        elif comp == "D-1":
-            return "0001110"
-        elif comp in ("A-1", "M-1"):
-            if comp == "A-1":
-                return "0110010"
-            else:
-                return "1110010"
-        elif comp in ("D+A", "D+M"):
-            if comp == "D+A":
-                return "0000010"
-            else:
-                return "1000010"
-        elif comp in ("D-A", "D-M"):
-            if comp == "D-A":
-                return "0010011"
-            else:
-                return "1010011"
-        elif comp in ("A-D", "M-D"):
-            if comp == "A-D":
-                return "0010011"
-            else:
-                return "1010011"
-        elif comp in ("D&A", "D&M"):
-            if comp == "D&A":
-                return "0000000"
-            else:
-                return "1000000"
-        elif comp in ("D|A", "D|M"):
-            if comp == "D|A":
-                return "0010101"
-            else:
-                return "1010101"
-        else:
-            raise CodeValidationError("?w????????comp?R?[?h???")
-
-    def jump(self):
-        if not self.jump_:
-            return "000"
-        jump = self.jump_
-        if jump == "JGT":
-            return "001"
-        elif jump == "JEQ":
-            return "010"
-        elif jump == "JGE":
-            return "011"
-        elif jump == "JLT":
-            return "100"
-        elif jump == "JNE":
-            return "101"
-        elif jump == "JLE":
-            return "110"
-        elif jump == "JMP":
-            return "111"
+        return self.instruction.jump
+
+
+DEST_TABLE = {
+    None: 0b000,
+    "M": 0b001,
+    "D": 0b010,
+    "MD": 0b011,
+    "A": 0b100,
+    "AM": 0b101,
+    "AD": 0b110,
+    "AMD": 0b111,
+}
+
+COMP_TABLE = {
+    "0": 0b0101010,
+    "1": 0b0111111,
+    "-1": 0b0111010,
+    "D": 0b0001100,
+    "A": 0b0110000,
+    "M": 0b1110000,
+    "!D": 0b0001101,
+    "!A": 0b0110001,
+    "!M": 0b1110001,
+    "-D": 0b0001111,
+    "-A": 0b0110011,
+    "-M": 0b1110011,
+    "D+1": 0b0011111,
+    "A+1": 0b0110111,
+    "M+1": 0b1110111,
+    "D-1": 0b0001110,
+    "A-1": 0b0110010,
+    "M-1": 0b1110010,
+    "D+A": 0b0000010,
+    "D+M": 0b1000010,
+    "D-A": 0b0010011,
+    "D-M": 0b1010011,
+    "A-D": 0b0000111,
+    "M-D": 0b1000111,
+    "D&A": 0b0000000,
+    "D&M": 0b1000000,
+    "D|A": 0b0010101,
+    "D|M": 0b1010101,
+}
+
+JUMP_TABLE = {
+    None: 0b000,
+    "JGT": 0b001,
+    "JEQ": 0b010,
+    "JGE": 0b011,
+    "JLT": 0b100,
+    "JNE": 0b101,
+    "JLE": 0b110,
+    "JMP": 0b111,
+}
+
+# every legal (dest, comp, jump) triple mapped to its 16 bit instruction word
+C_COMMAND_TABLE = {
+    (dest, comp, jump): (0b111 << 13) | (comp_bits << 6) | (dest_bits << 3) | jump_bits
+    for dest, dest_bits in DEST_TABLE.items()
+    for comp, comp_bits in COMP_TABLE.items()
+    for jump, jump_bits in JUMP_TABLE.items()
+}
+
+# text form of each word, filled on first use
+ROW_CACHE = [None] * 65536
+
+OUTPUT_FORMATS = ("hack", "bin")
+
+# part of the build cache key; bump whenever the generated code changes
+ASSEMBLER_VERSION = "1"
+DEFAULT_CACHE_DIR = ".hack_cache"
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+READ_CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 64 * 1024
+ROM_CHUNK_WORDS = 4096
 
 
 class SymbolTable(object):
@@ -312,86 +264,331 @@ class SymbolTable(object):
         return self.table[symbol]
 
 
-def main():
-    f = file_open()
-    parser = Parser(f)
-    write_file = write_file_open()
-    write_lines = []
-
-    # 1 pass
-    symbol_table = SymbolTable()
+def first_pass(instructions, symbol_table):
     row_num = 0
-    while True:
-        commandType = parser.commandType()
-        if commandType in (CommandType.A_COMMAND, CommandType.C_COMMAND):
+    for instruction in instructions:
+        if instruction.kind == CommandType.L_COMMAND:
+            symbol_table.addEntry(instruction.symbol, row_num)
+        else:
             row_num += 1
-        elif commandType == CommandType.L_COMMAND:
-            symbol_table.addEntry(parser.l_command(), row_num)
 
-        if not parser.hasMoreCommands():
-            break
 
-        parser.advance()
-    # 2 pass
-    parser.reset()
+def second_pass(instructions, symbol_table):
+    return list(iter_second_pass(instructions, symbol_table))
+
+
+def iter_second_pass(instructions, symbol_table):
     ram_address = 16
-    while True:
-        commandType = parser.commandType()
-        row = ""
-        if commandType == CommandType.A_COMMAND:
-            symbol = parser.symbol()
+    for instruction in instructions:
+        kind = instruction.kind
+        if kind == CommandType.A_COMMAND:
+            symbol = instruction.symbol
             if not symbol.isdecimal():
                 if not symbol_table.contains(symbol):
                     symbol_table.addEntry(symbol, ram_address)
-                    symbol = symbol_table.getAddress(symbol)
                     ram_address += 1
-                    symbol_binary = symbol_to_decimal_binary(symbol)
-                    row = symbol_binary_to_row(symbol_binary)
-                else:
-                    symbol = symbol_table.getAddress(symbol)
-                    symbol_binary = symbol_to_decimal_binary(symbol)
-                    row = symbol_binary_to_row(symbol_binary)
+                symbol = symbol_table.getAddress(symbol)
+            yield a_command_word(int(symbol), instruction.line)
+        elif kind == CommandType.C_COMMAND:
+            yield c_command_word(instruction.dest, instruction.comp, instruction.jump)
+
+
+def single_pass(instructions, symbol_table):
+    # emit every instruction once; A commands whose symbol is not known yet
+    # are recorded in the fixup list and patched after the last line
+    words = []
+    fixups = []
+    for instruction in instructions:
+        kind = instruction.kind
+        if kind == CommandType.A_COMMAND:
+            symbol = instruction.symbol
+            if symbol.isdecimal():
+                words.append(a_command_word(int(symbol), instruction.line))
+            elif symbol_table.contains(symbol):
+                words.append(a_command_word(symbol_table.getAddress(symbol), instruction.line))
             else:
-                symbol_binary = symbol_to_decimal_binary(symbol)
-                row = symbol_binary_to_row(symbol_binary)
-
-
-        elif commandType == CommandType.C_COMMAND:
-            dest = parser.dest()
-            comp = parser.comp()
-            jump = parser.jump()
-            c = Code(dest, comp, jump)
-            comp_binary = c.comp()
-            dest_binary = c.dest()
-            jump_binary = c.jump()
-            row = "111{} {}{}{}{} {}{}{}{} {}{}{}{}".format(
-                    comp_binary[0], comp_binary[1], comp_binary[2], comp_binary[3], comp_binary[4], comp_binary[5], comp_binary[6],
-                    dest_binary[0], dest_binary[1], dest_binary[2],
-                    jump_binary[0], jump_binary[1], jump_binary[2]
-                    )
-
-        row = row.strip()
-        if len(row) > 0:
-            write_lines.append(row + "\n")
-
-        if not parser.hasMoreCommands():
+                fixups.append((len(words), symbol, instruction.line))
+                words.append(None)
+        elif kind == CommandType.C_COMMAND:
+            words.append(c_command_word(instruction.dest, instruction.comp, instruction.jump))
+        elif kind == CommandType.L_COMMAND:
+            symbol_table.addEntry(instruction.symbol, len(words))
+
+    # symbols still unknown after all labels are seen are variables,
+    # allocated in order of first use like the second pass does
+    ram_address = 16
+    for index, symbol, line in fixups:
+        if not symbol_table.contains(symbol):
+            symbol_table.addEntry(symbol, ram_address)
+            ram_address += 1
+        words[index] = a_command_word(symbol_table.getAddress(symbol), line)
+
+    return words
+
+
+def write_hack(words, write_file):
+    write_file.writelines(word_to_row(word) + "\n" for word in words)
+
+
+def write_rom(words, write_file):
+    # packed little-endian 16 bit words, one per ROM address, written in
+    # chunks so a lazily produced word stream is never held in memory
+    words = iter(words)
+    while True:
+        rom = array("H", itertools.islice(words, ROM_CHUNK_WORDS))
+        if not rom:
             break
+        if sys.byteorder != "little":
+            rom.byteswap()
+        rom.tofile(write_file)
+
+
+def read_rom(path):
+    # memory-map a ROM image written by write_rom; returns a sequence of words
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return array("H")
+        rom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder != "little":
+        # iterating the mmap gives single bytes, so copy it in whole and swap
+        words = array("H")
+        words.frombytes(rom)
+        words.byteswap()
+        rom.close()
+        return words
+    return memoryview(rom).cast("H")
+
+
+class BuildCache(object):
+    # assembled outputs keyed by a hash of the source, the assembler version
+    # and the output format; least recently used entries are evicted first
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, source, output_format):
+        return self.key_chunks([source], output_format)
+
+    def key_file(self, file_name, output_format):
+        with file_open(file_name) as f:
+            return self.key_chunks(iter(lambda: f.read(READ_CHUNK_SIZE), ""), output_format)
+
+    def key_chunks(self, chunks, output_format):
+        h = hashlib.sha256()
+        h.update(ASSEMBLER_VERSION.encode())
+        h.update(b"\0")
+        h.update(output_format.encode())
+        h.update(b"\0")
+        for chunk in chunks:
+            h.update(chunk.encode())
+        return h.hexdigest()
+
+    def get(self, key, write_path):
+        cached = os.path.join(self.path, key)
+        try:
+            shutil.copyfile(cached, write_path)
+            os.utime(cached)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    def put(self, key, write_path):
+        cached = os.path.join(self.path, key)
+        # copy under a private name first so concurrent workers never see a partial entry
+        tmp = "{}.{}.tmp".format(cached, os.getpid())
+        shutil.copyfile(write_path, tmp)
+        os.replace(tmp, cached)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_cache(options):
+    cache_dir = get_option_value(options, "--cache-dir", None)
+    if cache_dir is None and "--cache" in options:
+        cache_dir = DEFAULT_CACHE_DIR
+    if cache_dir is None:
+        return None
+    return BuildCache(cache_dir, int(get_option_value(options, "--cache-size", DEFAULT_CACHE_SIZE)))
+
+
+def assemble_stream(file_name, output_format, cache=None):
+    # constant memory: the first pass keeps only label positions and the
+    # second pass re-reads the source while writing through a buffer
+    write_path = write_file_name(file_name, output_format)
+    if cache:
+        key = cache.key_file(file_name, output_format)
+        if cache.get(key, write_path):
+            return write_path
 
-        parser.advance()
+    symbol_table = SymbolTable()
+    with file_open(file_name) as f:
+        first_pass(iter_instructions(f), symbol_table)
+    with file_open(file_name) as f, write_file_open(file_name, output_format, WRITE_BUFFER_SIZE) as write_file:
+        words = iter_second_pass(iter_instructions(f), symbol_table)
+        if output_format == "bin":
+            write_rom(words, write_file)
+        else:
+            write_hack(words, write_file)
+
+    if cache:
+        cache.put(key, write_path)
+    return write_path
+
+
+def assemble_single_pass(file_name, output_format, cache=None):
+    # one read of the source: lines are parsed and encoded as they come in,
+    # only the words and the forward reference fixups are kept
+    write_path = write_file_name(file_name, output_format)
+    if cache:
+        key = cache.key_file(file_name, output_format)
+        if cache.get(key, write_path):
+            return write_path
+
+    symbol_table = SymbolTable()
+    with file_open(file_name) as f:
+        words = single_pass(iter_instructions(f), symbol_table)
+    with write_file_open(file_name, output_format, WRITE_BUFFER_SIZE) as write_file:
+        if output_format == "bin":
+            write_rom(words, write_file)
+        else:
+            write_hack(words, write_file)
+
+    if cache:
+        cache.put(key, write_path)
+    return write_path
+
+
+def assemble(file_name, options, cache=None):
+    output_format = get_option_value(options, "--format", "hack")
+    if output_format not in OUTPUT_FORMATS:
+        raise FileParseError("unknown output format {}".format(output_format))
+    if "--stream" in options:
+        return assemble_stream(file_name, output_format, cache)
+    if "--single-pass" in options:
+        return assemble_single_pass(file_name, output_format, cache)
 
+    f = file_open(file_name)
+    source = f.read()
+    f.close()
+    write_path = write_file_name(file_name, output_format)
 
-    write_file.writelines(write_lines)
+    if cache:
+        key = cache.key(source, output_format)
+        if cache.get(key, write_path):
+            return write_path
+
+    parser = Parser(io.StringIO(source))
+    symbol_table = SymbolTable()
+    first_pass(parser.instructions, symbol_table)
+    words = second_pass(parser.instructions, symbol_table)
+
+    write_file = write_file_open(file_name, output_format)
+    if output_format == "bin":
+        write_rom(words, write_file)
+    else:
+        write_hack(words, write_file)
     write_file.close()
 
+    if cache:
+        cache.put(key, write_path)
+    return write_path
+
+
+def assemble_timed(file_name, options):
+    # process pool worker; errors are returned so one bad file does not stop the batch
+    start = time.perf_counter()
+    cache = get_cache(options)
+    try:
+        assemble(file_name, options, cache)
+        error = None
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    hit = bool(cache and cache.hits)
+    return file_name, time.perf_counter() - start, error, hit
+
+
+def batch(paths, options):
+    files = get_files(paths)
+    if not files:
+        raise FileParseError("no asm files found")
+    jobs = int(get_option_value(options, "--jobs", 0)) or None
+
+    failed = 0
+    hits = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(assemble_timed, file_name, options) for file_name in files]
+        for future in futures:
+            file_name, elapsed, error, hit = future.result()
+            if error:
+                failed += 1
+                print("FAILED {} ({:.3f}s) {}".format(file_name, elapsed, error))
+            else:
+                hits += hit
+                print("{} {} ({:.3f}s)".format("cached" if hit else "ok    ", file_name, elapsed))
+    print("{} files, {} failed, {:.3f}s".format(len(files), failed, time.perf_counter() - start))
+    if get_cache(options):
+        print("cache: {} hits, {} misses".format(hits, len(files) - failed - hits))
+    return 1 if failed else 0
+
 
-def symbol_to_decimal_binary(num):
-    decimal = int(num)
-    symbol_binary = bin(decimal)[2:]
-    length = len(symbol_binary)
-    miss = 16 - length
-    fill = "".join(["0" for i in range(0, miss)])
-    symbol_binary = fill + symbol_binary
-    return symbol_binary
+def main():
+    options = get_options()
+    if "--batch" in options:
+        return batch(get_paths(), options)
+
+    paths = get_paths()
+    if not paths:
+        raise FileParseError("no asm file given")
+    assemble(paths[0], options, get_cache(options))
+    return 0
+
+
+def a_command_word(value, line):
+    # 15 bits: 32768 and up would set the C command bit
+    if not 0 <= value <= 32767:
+        raise CodeValidationError("line {}: @{} is out of range 0-32767".format(line, value))
+    return value
+
+def c_command_word(dest, comp, jump):
+    key = (dest, comp, jump)
+    if key not in C_COMMAND_TABLE:
+        raise CodeValidationError("?w????????comp?R?[?h???")
+    return C_COMMAND_TABLE[key]
+
+def word_to_row(word):
+    row = ROW_CACHE[word]
+    if row is None:
+        row = symbol_binary_to_row("{:016b}".format(word))
+        ROW_CACHE[word] = row
+    return row
 
 def symbol_binary_to_row(symbol_binary):
     row = "{}{}{}{} {}{}{}{} {}{}{}{} {}{}{}{}".format(
@@ -404,36 +601,64 @@ def symbol_binary_to_row(symbol_binary):
             )
     return row
 
-def file_open():
-    value = sys.argv
-    if 1 >= len(value):
+def get_paths():
+    return [v for v in sys.argv[1:] if not v.startswith("--")]
+
+def get_options():
+    return [v for v in sys.argv[1:] if v.startswith("--")]
+
+def get_option_value(options, name, default):
+    for option in options:
+        if option.startswith(name + "="):
+            return option.split("=", 1)[1]
+    return default
+
+def get_files(paths):
+    # expand directories (recursively) and glob patterns into sorted asm paths;
+    # paths are normalized so one file named two ways is assembled once
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                for name in names:
+                    if name.endswith(".asm"):
+                        files.add(os.path.normpath(os.path.join(root, name)))
+        else:
+            for name in glob.glob(path, recursive=True) or [path]:
+                if name.endswith(".asm"):
+                    files.add(os.path.normpath(name))
+    return sorted(files)
+
+def check_file_name(file_name):
+    if not file_name:
         raise FileParseError("?t?@?C?????w????????????")
-    file_name = value[1]
-    splited_file_name = file_name.split(".")
-    if 1 >= len(splited_file_name):
+    base, ext = os.path.splitext(file_name)
+    if not ext:
         raise FileParseError("?g???q???w????????????")
 
-    if "asm" != splited_file_name[1]:
+    if ".asm" != ext:
         raise FileParseError("asm?t?@?C?????w???????????")
+    return base
 
+def file_open(file_name):
+    check_file_name(file_name)
     f = open(file_name, "r")
     return f
 
-def write_file_open():
-    value = sys.argv
-    if 1 >= len(value):
-        raise FileParseError("?t?@?C?????w????????????")
-    file_name = value[1]
-    splited_file_name = file_name.split(".")
-    if 1 >= len(splited_file_name):
-        raise FileParseError("?g???q???w????????????")
+def write_file_name(file_name, output_format="hack"):
+    base = check_file_name(file_name)
+    if output_format == "bin":
+        return "{}.bin".format(base)
+    return "{}.hack".format(base)
 
-    if "asm" != splited_file_name[1]:
-        raise FileParseError("asm?t?@?C?????w???????????")
+def write_file_open(file_name, output_format="hack", buffering=-1):
+    write_path = write_file_name(file_name, output_format)
+    if output_format == "bin":
+        return open(write_path, "wb", buffering)
 
-    f = open("{}.hack".format(splited_file_name[0]), "w")
+    f = open(write_path, "w", buffering)
     return f
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,361 @@
+import os
+import time
+from array import array
+
+from VMtranslator import Parser, Opcode, Segment, file_open, get_files, get_options, get_option_value
+
+
+class EmulatorError(Exception):
+    pass
+
+RAM_SIZE = 32768
+STATIC_BASE = 16
+STATIC_END = 256
+SEG_POINTERS = {Segment.LOCAL: 1, Segment.ARGUMENT: 2, Segment.THIS: 3, Segment.THAT: 4}
+SEG_BASE = {Segment.TEMP: 5, Segment.POINTER: 3}
+DEFAULT_STEPS = 10000000
+# returned by a handler to stop the run: a goto to itself, or a return to the bootstrap frame
+HALT = -1
+
+
+def wrap(value):
+    # 16 bit two's complement, as stored in array('h')
+    return ((value + 32768) & 0xFFFF) - 32768
+
+
+class Program(object):
+    # the commands of every file in one list, with labels, functions and
+    # static variables resolved to command indexes and RAM addresses
+    def __init__(self, files):
+        self.commands = []
+        self.file_names = []
+        self.function_names = []
+        self.labels = {}
+        self.functions = {}
+        self.statics = {}
+        for file_path in files:
+            f = file_open(file_path)
+            parser = Parser(f)
+            f.close()
+            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            function_name = None
+            for command in parser.commands:
+                pc = len(self.commands)
+                if command.opcode == Opcode.FUNCTION:
+                    function_name = command.name
+                    self.functions[function_name] = pc
+                elif command.opcode == Opcode.LABEL:
+                    self.labels[(function_name, command.name)] = pc
+                elif command.segment == Segment.STATIC and (file_name, command.index) not in self.statics:
+                    self.statics[(file_name, command.index)] = STATIC_BASE + len(self.statics)
+                self.commands.append(command)
+                self.file_names.append(file_name)
+                self.function_names.append(function_name)
+        if len(self.commands) > 32767:
+            raise EmulatorError("program too long for 16 bit return addresses")
+        if STATIC_BASE + len(self.statics) > STATIC_END:
+            raise EmulatorError("too many static variables")
+        # labels are never executed: control passes to the next real command
+        self.next_commands = list(range(len(self.commands) + 1))
+        for pc in range(len(self.commands) - 1, -1, -1):
+            if self.commands[pc].opcode == Opcode.LABEL:
+                self.next_commands[pc] = self.next_commands[pc + 1]
+
+    def next_pc(self, pc):
+        return self.next_commands[pc + 1]
+
+    def label(self, pc, name):
+        key = (self.function_names[pc], name)
+        if key not in self.labels:
+            raise EmulatorError("label {} not found".format(name))
+        return self.next_commands[self.labels[key]]
+
+
+def compile_binary(ram, program, pc, command):
+    next_pc = program.next_pc(pc)
+    opcode = command.opcode
+    if opcode == Opcode.ADD:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp - 1] = wrap(ram[sp - 1] + ram[sp])
+            ram[0] = sp
+            return next_pc
+    elif opcode == Opcode.SUB:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp - 1] = wrap(ram[sp - 1] - ram[sp])
+            ram[0] = sp
+            return next_pc
+    elif opcode == Opcode.AND:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp - 1] = ram[sp - 1] & ram[sp]
+            ram[0] = sp
+            return next_pc
+    elif opcode == Opcode.OR:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp - 1] = ram[sp - 1] | ram[sp]
+            ram[0] = sp
+            return next_pc
+    elif opcode == Opcode.EQ:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp - 1] = -1 if ram[sp - 1] == ram[sp] else 0
+            ram[0] = sp
+            return next_pc
+    elif opcode == Opcode.GT:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp - 1] = -1 if ram[sp - 1] > ram[sp] else 0
+            ram[0] = sp
+            return next_pc
+    else:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp - 1] = -1 if ram[sp - 1] < ram[sp] else 0
+            ram[0] = sp
+            return next_pc
+    return handler
+
+
+def compile_unary(ram, program, pc, command):
+    next_pc = program.next_pc(pc)
+    if command.opcode == Opcode.NEG:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp] = wrap(-ram[sp])
+            return next_pc
+    else:
+        def handler():
+            sp = ram[0] - 1
+            ram[sp] = ~ram[sp]
+            return next_pc
+    return handler
+
+
+def segment_address(program, pc, command):
+    # fixed RAM address of a temp, pointer or static entry
+    if command.segment == Segment.STATIC:
+        return program.statics[(program.file_names[pc], command.index)]
+    return SEG_BASE[command.segment] + command.index
+
+
+def compile_push(ram, program, pc, command):
+    next_pc = program.next_pc(pc)
+    segment = command.segment
+    index = command.index
+    if segment == Segment.CONSTANT:
+        value = wrap(index)
+        def handler():
+            sp = ram[0]
+            ram[sp] = value
+            ram[0] = sp + 1
+            return next_pc
+    elif segment in SEG_POINTERS:
+        pointer = SEG_POINTERS[segment]
+        def handler():
+            sp = ram[0]
+            ram[sp] = ram[ram[pointer] + index]
+            ram[0] = sp + 1
+            return next_pc
+    else:
+        address = segment_address(program, pc, command)
+        def handler():
+            sp = ram[0]
+            ram[sp] = ram[address]
+            ram[0] = sp + 1
+            return next_pc
+    return handler
+
+
+def compile_pop(ram, program, pc, command):
+    next_pc = program.next_pc(pc)
+    segment = command.segment
+    index = command.index
+    if segment == Segment.CONSTANT:
+        raise EmulatorError("cant pop to constant")
+    elif segment in SEG_POINTERS:
+        pointer = SEG_POINTERS[segment]
+        def handler():
+            sp = ram[0] - 1
+            ram[ram[pointer] + index] = ram[sp]
+            ram[0] = sp
+            return next_pc
+    else:
+        address = segment_address(program, pc, command)
+        def handler():
+            sp = ram[0] - 1
+            ram[address] = ram[sp]
+            ram[0] = sp
+            return next_pc
+    return handler
+
+
+def compile_label(ram, program, pc, command):
+    next_pc = program.next_pc(pc)
+    def handler():
+        return next_pc
+    return handler
+
+
+def compile_goto(ram, program, pc, command):
+    target = program.label(pc, command.name)
+    # a goto back to its own label is the usual end of a program
+    if target == pc:
+        target = HALT
+    def handler():
+        return target
+    return handler
+
+
+def compile_if(ram, program, pc, command):
+    next_pc = program.next_pc(pc)
+    target = program.label(pc, command.name)
+    def handler():
+        sp = ram[0] - 1
+        ram[0] = sp
+        return target if ram[sp] else next_pc
+    return handler
+
+
+def compile_function(ram, program, pc, command):
+    next_pc = program.next_pc(pc)
+    locals_count = command.index
+    def handler():
+        sp = ram[0]
+        for i in range(sp, sp + locals_count):
+            ram[i] = 0
+        ram[0] = sp + locals_count
+        return next_pc
+    return handler
+
+
+def compile_call(ram, program, pc, command):
+    return_pc = program.next_pc(pc)
+    name = command.name
+    args = command.index
+    def handler():
+        if name not in program.functions:
+            raise EmulatorError("function {} not found".format(name))
+        sp = ram[0]
+        ram[sp] = return_pc
+        ram[sp + 1] = ram[1]
+        ram[sp + 2] = ram[2]
+        ram[sp + 3] = ram[3]
+        ram[sp + 4] = ram[4]
+        ram[2] = sp - args
+        ram[1] = sp + 5
+        ram[0] = sp + 5
+        return program.functions[name]
+    return handler
+
+
+def compile_return(ram, program, pc, command):
+    def handler():
+        frame = ram[1]
+        return_pc = ram[frame - 5]
+        arg = ram[2]
+        ram[arg] = ram[ram[0] - 1]
+        ram[0] = arg + 1
+        ram[4] = ram[frame - 1]
+        ram[3] = ram[frame - 2]
+        ram[2] = ram[frame - 3]
+        ram[1] = ram[frame - 4]
+        return return_pc
+    return handler
+
+
+HANDLERS = {opcode: compile_binary for opcode in (Opcode.ADD, Opcode.SUB, Opcode.AND, Opcode.OR,
+        Opcode.EQ, Opcode.GT, Opcode.LT)}
+HANDLERS.update({
+    Opcode.NEG: compile_unary,
+    Opcode.NOT: compile_unary,
+    Opcode.PUSH: compile_push,
+    Opcode.POP: compile_pop,
+    Opcode.LABEL: compile_label,
+    Opcode.GOTO: compile_goto,
+    Opcode.IF_GOTO: compile_if,
+    Opcode.FUNCTION: compile_function,
+    Opcode.CALL: compile_call,
+    Opcode.RETURN: compile_return,
+})
+
+
+class VMEmulator(object):
+    def __init__(self, program):
+        self.program = program
+        # RAM, stack included, preallocated as 16 bit words
+        self.ram = array("h", bytes(2 * RAM_SIZE))
+        # every command is compiled once into a handler that returns the next pc
+        self.code = [HANDLERS[command.opcode](self.ram, program, pc, command)
+                for pc, command in enumerate(program.commands)]
+        self.counts = array("L", bytes(array("L").itemsize * len(self.code)))
+        self.pc = program.functions.get("Sys.init", program.next_commands[0])
+        self.steps = 0
+
+    def bootstrap(self):
+        # SP = 256 and call Sys.init, whose return halts the emulator
+        ram = self.ram
+        ram[0] = 256
+        ram[256] = HALT
+        for i in range(1, 5):
+            ram[256 + i] = ram[i]
+        ram[2] = 256
+        ram[1] = 261
+        ram[0] = 261
+        self.pc = self.program.functions["Sys.init"]
+
+    def run(self, max_steps=DEFAULT_STEPS):
+        code = self.code
+        counts = self.counts
+        pc = self.pc
+        end = len(code)
+        steps = 0
+        while steps < max_steps and 0 <= pc < end:
+            counts[pc] += 1
+            pc = code[pc]()
+            steps += 1
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+    def function_counts(self):
+        counts = {}
+        for pc, count in enumerate(self.counts):
+            if count:
+                name = self.program.function_names[pc] or self.program.file_names[pc]
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+
+def main():
+    files = get_files()
+    options = get_options()
+    max_steps = int(get_option_value(options, "--steps", DEFAULT_STEPS))
+
+    emulator = VMEmulator(Program(files))
+    if "Sys.init" in emulator.program.functions and "--no-bootstrap" not in options:
+        emulator.bootstrap()
+    else:
+        emulator.ram[0] = 256
+    # --set=ADDRESS:VALUE, repeatable, applied after the bootstrap
+    for option in options:
+        if option.startswith("--set="):
+            address, value = option.split("=", 1)[1].split(":")
+            emulator.ram[int(address)] = wrap(int(value))
+
+    start = time.perf_counter()
+    steps = emulator.run(max_steps)
+    elapsed = time.perf_counter() - start
+    print("{} commands in {:.3f}s ({:,.0f} commands/s)".format(steps, elapsed, steps / elapsed if elapsed > 0 else 0))
+    for name, count in sorted(emulator.function_counts().items(), key=lambda item: -item[1]):
+        print("    {:<32} {:>12}".format(name, count))
+
+    addresses = get_option_value(options, "--ram", "")
+    for address in addresses.split(","):
+        if address:
+            print("RAM[{}] = {}".format(address, emulator.ram[int(address)]))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
+import io
 import os
 import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 
@@ -22,6 +25,144 @@ class FileParseError(Exception):
 
 SEG_CONS = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
 
+# hack_assembler.py: CodeWriter emits its Instruction records, which the
+# fused VM to ROM pipeline hands straight to the encoder
+ASSEMBLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "06")
+if ASSEMBLER_DIR not in sys.path:
+    sys.path.append(ASSEMBLER_DIR)
+import hack_assembler
+
+A_COMMAND = hack_assembler.CommandType.A_COMMAND
+C_COMMAND = hack_assembler.CommandType.C_COMMAND
+L_COMMAND = hack_assembler.CommandType.L_COMMAND
+# the writer repeats a small set of commands, so each record is made once;
+# equal records are then mostly the same object, which compares fastest
+A_COMMANDS = {}
+C_COMMANDS = {}
+# the same goes for the code of whole commands without labels
+COMMAND_LINES = {}
+
+
+# hack_assembler's Instruction fields, which the assembler passes read, plus
+# the .asm text rendered once when the record is made, so writing .asm costs
+# no more than writing strings did
+AsmInstruction = namedtuple("AsmInstruction", hack_assembler.Instruction._fields + ("text",))
+
+
+def a_command(symbol):
+    instruction = A_COMMANDS.get(symbol)
+    if instruction is None:
+        text = str(symbol)
+        instruction = A_COMMANDS[symbol] = AsmInstruction(A_COMMAND, text, None, None, None, 0, "@" + text)
+    return instruction
+
+
+def c_command(dest, comp, jump=None):
+    key = (dest, comp, jump)
+    instruction = C_COMMANDS.get(key)
+    if instruction is None:
+        instruction = C_COMMANDS[key] = AsmInstruction(C_COMMAND, None, dest, comp, jump, 0,
+                format_c_command(dest, comp, jump))
+    return instruction
+
+
+def l_command(label):
+    return AsmInstruction(L_COMMAND, label, None, None, None, 0, "(" + label + ")")
+
+
+def asm_text(instructions):
+    # assembler text of records, for .asm output only
+    return "\n".join([instruction.text for instruction in instructions]) + "\n"
+
+
+def format_c_command(dest, comp, jump):
+    line = comp
+    if dest:
+        line = dest + "=" + line
+    if jump:
+        line = line + ";" + jump
+    return line
+
+
+class Opcode(Enum):
+    ADD = "add"
+    SUB = "sub"
+    NEG = "neg"
+    EQ = "eq"
+    GT = "gt"
+    LT = "lt"
+    AND = "and"
+    OR = "or"
+    NOT = "not"
+    PUSH = "push"
+    POP = "pop"
+    LABEL = "label"
+    GOTO = "goto"
+    IF_GOTO = "if-goto"
+    FUNCTION = "function"
+    CALL = "call"
+    RETURN = "return"
+
+class Segment(Enum):
+    CONSTANT = "constant"
+    LOCAL = "local"
+    ARGUMENT = "argument"
+    THIS = "this"
+    THAT = "that"
+    TEMP = "temp"
+    POINTER = "pointer"
+    STATIC = "static"
+
+ARITHMETIC_OPCODES = (Opcode.ADD, Opcode.SUB, Opcode.NEG, Opcode.EQ, Opcode.GT, Opcode.LT, Opcode.AND, Opcode.OR, Opcode.NOT)
+
+COMMAND_TYPES = {opcode: CommandType.C_ARITHMETIC for opcode in ARITHMETIC_OPCODES}
+COMMAND_TYPES.update({
+    Opcode.PUSH: CommandType.C_PUSH,
+    Opcode.POP: CommandType.C_POP,
+    Opcode.LABEL: CommandType.C_LABEL,
+    Opcode.GOTO: CommandType.C_GOTO,
+    Opcode.IF_GOTO: CommandType.C_IF,
+    Opcode.FUNCTION: CommandType.C_FUNCTION,
+    Opcode.RETURN: CommandType.C_RETURN,
+    Opcode.CALL: CommandType.C_CALL,
+})
+
+OPCODES = {opcode.value: opcode for opcode in Opcode}
+SEGMENTS = {segment.value: segment for segment in Segment}
+
+
+class Command(object):
+    # one classified vm command; index is the push/pop index or the
+    # function/call count, name the label, function or callee name
+    __slots__ = ("opcode", "segment", "index", "name")
+
+    def __init__(self, opcode, segment=None, index=None, name=None):
+        self.opcode = opcode
+        self.segment = segment
+        self.index = index
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and self.opcode == other.opcode and self.segment == other.segment \
+                and self.index == other.index and self.name == other.name
+
+    def __repr__(self):
+        return "Command({}, {}, {}, {})".format(self.opcode, self.segment, self.index, self.name)
+
+
+def parse_command(line):
+    words = line.split("//")[0].split()
+    if not words or words[0] not in OPCODES:
+        return None
+    opcode = OPCODES[words[0]]
+    if opcode in (Opcode.PUSH, Opcode.POP):
+        return Command(opcode, SEGMENTS[words[1]], int(words[2]))
+    elif opcode in (Opcode.FUNCTION, Opcode.CALL):
+        return Command(opcode, index=int(words[2]), name=words[1])
+    elif opcode in (Opcode.LABEL, Opcode.GOTO, Opcode.IF_GOTO):
+        return Command(opcode, name=words[1])
+    return Command(opcode)
+
 
 class Parser(object):
     def __init__(self, file_):
@@ -29,6 +170,8 @@ class Parser(object):
         for line in file_.readlines():
             self.lines.append(line)
         self.line_sum = len(self.lines)
+        self.records = [parse_command(line) for line in self.lines]
+        self.commands = [record for record in self.records if record is not None]
         self.now_line = 0
         self.set_command()
 
@@ -40,6 +183,7 @@ class Parser(object):
 
     def set_command(self):
         self.command = self.normalize(self.lines[self.now_line]).strip()
+        self.record = self.records[self.now_line]
 
     def advance(self):
         if self.hasMoreCommands():
@@ -47,140 +191,179 @@ class Parser(object):
             self.set_command()
 
     def commandType(self):
-        command = self.command
-        if self.is_artithmetic(command):
-            return CommandType.C_ARITHMETIC
-        elif self.is_push(command):
-            return CommandType.C_PUSH
-        elif self.is_pop(command):
-            return CommandType.C_POP
-        elif self.is_label(command):
-            return CommandType.C_LABEL
-        elif self.is_call(command):
-            return CommandType.C_CALL
-        elif self.is_function(command):
-            return CommandType.C_FUNCTION
-        elif self.is_goto(command):
-            return CommandType.C_GOTO
-        elif self.is_return(command):
-            return CommandType.C_RETURN
-        elif self.is_call(command):
-            return CommandType.C_CALL
-        elif self.is_if(command):
-            return CommandType.C_IF
-
-    def is_artithmetic(self, command):
-        op = self.op()
-        if op in ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"):
-            return True
-        
-        return False
+        if self.record is None:
+            return None
+        return COMMAND_TYPES[self.record.opcode]
 
-    def is_push(self, command):
-        op = self.op()
-        if op == "push":
-            return True
+    def op(self):
+        return self.command.split(" ")[0]
+    
+    def arg1(self):
+        record = self.record
+        if record.opcode in ARITHMETIC_OPCODES:
+            return record.opcode.value
+        elif record.segment is not None:
+            return record.segment.value
+        else:
+            return record.name
 
-        return False
+    def arg2(self):
+        return str(self.record.index)
 
-    def is_label(self, command):
-        op = self.op()
-        if op == "label":
-            return True
 
-        return False
+# tail of every push: store D on the stack and increment SP
+PUSH_TAIL = [a_command("SP"), c_command("A", "M"), c_command("M", "D"), a_command("SP"), c_command("M", "M+1")]
+# heads of the commands that pop the stack top into D
+POP_TO_D_HEADS = [
+    [a_command("SP"), c_command("M", "M-1"), a_command("SP"), c_command("A", "M"), c_command("D", "M")],
+    [a_command("SP"), c_command("AM", "M-1"), c_command("D", "M")],
+]
+# pop into a computed address: SP decrement, address calculation into R13, store
+POP_SEGMENT_HEAD = [a_command("SP"), c_command("M", "M-1")]
+POP_SEGMENT_TAIL = [a_command("13"), c_command("M", "D"), a_command("SP"), c_command("A", "M"), c_command("D", "M"),
+        a_command("13"), c_command("A", "M"), c_command("M", "D")]
+# the caller's LCL, ARG, THIS and THAT, as a call pushes them
+CALLER_FRAME = [instruction for symbol in ("LCL", "ARG", "THIS", "THAT")
+        for instruction in [a_command(symbol), c_command("D", "M")] + PUSH_TAIL]
+# ARG = SP - A and LCL = SP, with n + 5 for a call of n arguments in A
+CALLEE_FRAME = [c_command("D", "A"), a_command("SP"), c_command("D", "M-D"), a_command("ARG"), c_command("M", "D"),
+        a_command("SP"), c_command("D", "M"), a_command("LCL"), c_command("M", "D")]
+LOAD_A_FROM_M = c_command("A", "M")
+# SP increment and decrement, which cancel out when adjacent
+SP_INCREMENTS = ((c_command("M", "M+1"), c_command("M", "M-1")), (c_command("M", "M-1"), c_command("M", "M+1")))
+# longest push/pop sequence fuse_push_pop looks at
+FUSE_WINDOW = 32
 
-    def is_pop(self, command):
-        op = self.op()
-        if op == "pop":
-            return True
 
-        return False
+def is_label(line):
+    return line.kind == L_COMMAND
 
-    def is_call(self, command):
-        op = self.op()
-        if op == "call":
-            return True
 
-        return False
+def a_register_written(line):
+    if line.kind != C_COMMAND:
+        return True
+    return line.dest is not None and "A" in line.dest
 
-    def is_goto(self, command):
-        op = self.op()
-        if op == "goto":
-            return True
 
-        return False
+def fuse_push_pop(lines):
+    # returns (replacement, consumed) when lines start with a push that is popped right away
+    if lines[:len(PUSH_TAIL)] != PUSH_TAIL:
+        return None
+    j = len(PUSH_TAIL)
+    for head in POP_TO_D_HEADS:
+        if lines[j:j + len(head)] == head:
+            # D already holds the pushed value
+            return [], j + len(head)
+    if lines[j:j + len(POP_SEGMENT_HEAD)] == POP_SEGMENT_HEAD:
+        k = j + len(POP_SEGMENT_HEAD)
+        end = k
+        while end < len(lines) and end - k < 8 and lines[end:end + len(POP_SEGMENT_TAIL)] != POP_SEGMENT_TAIL:
+            if is_label(lines[end]) or lines[end] == a_command("SP"):
+                return None
+            end += 1
+        if lines[end:end + len(POP_SEGMENT_TAIL)] != POP_SEGMENT_TAIL:
+            return None
+        # keep the value in R14 while the target address is computed
+        replacement = [a_command("14"), c_command("M", "D")] + lines[k:end] + [a_command("13"), c_command("M", "D"),
+                a_command("14"), c_command("D", "M"), a_command("13"), c_command("A", "M"), c_command("M", "D")]
+        return replacement, end + len(POP_SEGMENT_TAIL)
+    return None
 
-    def is_if(self, command):
-        op = self.op()
-        if op == "if-goto":
-            return True
-  
-        return False
 
-    def is_function(self, command):
-        op = self.op()
-        if op == "function":
-            return True
+def peephole_once(lines):
+    out = []
+    a_value = None
+    # remaining input as a stack, so fused replacements are pushed back cheaply
+    pending = lines[::-1]
+    while pending:
+        fused = fuse_push_pop(pending[:-FUSE_WINDOW - 1:-1])
+        if fused:
+            replacement, consumed = fused
+            del pending[len(pending) - consumed:]
+            pending.extend(reversed(replacement))
+            continue
 
-        return False
+        line = pending.pop()
+        prev = out[-1] if out else None
+        if line.kind == A_COMMAND:
+            if line == a_value:
+                # A already holds this value
+                continue
+            if prev is not None and prev.kind == A_COMMAND:
+                # the previous A load was never used
+                out.pop()
+        elif prev is not None and (prev, line) in SP_INCREMENTS:
+            out.pop()
+            continue
+        elif line == LOAD_A_FROM_M and prev is not None and prev.dest == "M":
+            out[-1] = c_command("AM", prev.comp, prev.jump)
+            a_value = None
+            continue
 
-    def is_return(self, command):
-        op = self.op()
-        if op == "return":
-            return True 
+        out.append(line)
+        if line.kind == A_COMMAND:
+            a_value = line
+        elif a_register_written(line):
+            a_value = None
+    return out
 
-        return False
 
-    def is_call(self, command):
-        op = self.op()
-        if op == "call":
-            return True
+def peephole(lines):
+    # rewrite translated assembly until no rule applies any more
+    while True:
+        optimized = peephole_once(lines)
+        if optimized == lines:
+            return optimized
+        lines = optimized
 
-        return False
 
-    def op(self):
-        return self.command.split(" ")[0]
-    
-    def arg1(self):
-        splited_command = self.command.split(" ")
-        op = splited_command[0]
-        arg1 = splited_command[1]
-        if self.commandType() == CommandType.C_ARITHMETIC:
-            return op
-        elif self.commandType() == CommandType.C_PUSH:
-            return arg1
-        elif self.commandType() == CommandType.C_POP:
-            return arg1
-        else:
-            return arg1
+# buffered output lines written per chunk
+FLUSH_LINES = 8192
 
-    def arg2(self):
-        splited_command = self.command.split(" ")
-        arg2 = splited_command[2]
-        if self.commandType() == CommandType.C_PUSH:
-            return arg2
-        elif self.commandType() == CommandType.C_POP:
-            return arg2
-        elif self.commandType() == CommandType.C_FUNCTION:
-            return arg2
-        elif self.commandType() == CommandType.C_RETURN:
-            return arg2
-        elif self.commandType() == CommandType.C_CALL:
-            return arg2
+# jump condition on x - y for the shared comparison subroutines
+COMPARE_JUMPS = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+
+# D = x op y with y in D and x in M, for the stack-top caching mode
+CACHED_BINARY_OPS = {"add": c_command("D", "D+M"), "sub": c_command("D", "M-D"), "and": c_command("D", "D&M"),
+        "or": c_command("D", "D|M")}
+CACHED_UNARY_OPS = {"neg": c_command("D", "-D"), "not": c_command("D", "!D")}
+# move the top between D and the stack
+SPILL_TOP = [a_command("SP"), c_command("AM", "M+1"), c_command("A", "A-1"), c_command("M", "D")]
+LOAD_TOP = [a_command("SP"), c_command("AM", "M-1"), c_command("D", "M")]
+SEG_BASE = {"temp": 5, "pointer": 3}
 
 
 class CodeWriter(object):
-    def __init__(self, name):
-        f = open("{}.asm".format(name), "w")
+    def __init__(self, name, bootstrap=True, optimize=False, compact=False, cache_top=False, fragment=False):
+        # without a name the assembly is kept in memory and returned by close();
+        # a fragment writer only collects its code for fragment()
+        f = open("{}.asm".format(name), "w") if name else io.StringIO()
+        self.fragment_mode = fragment
+        # stack-top caching: while top_in_d is set the top of the VM stack
+        # lives in D instead of RAM[SP - 1]; it is spilled at block boundaries
+        self.cache_top = cache_top
+        self.top_in_d = False
+        self.optimize = optimize
+        # output lines not written yet, flushed in large chunks
+        self.buffer = []
+        # compact mode: comparisons, call and return jump to shared subroutines
+        # that are emitted once, in order of first use, by close()
+        self.compact = compact
+        self.subroutines = []
         self.eq_if_use_count = 0
         self.gt_if_use_count = 0
         self.lt_if_use_count = 0
         self.file = f
         self.full_path = name
-        self.file_name = name.split("/")[-1]
+        self.file_name = name.split("/")[-1] if name else ""
+        # names the static variables; differs from file_name inside an inlined body
+        self.static_name = self.file_name
+        # prefix for the comparison labels, set per file for object fragments
+        self.label_prefix = ""
+        self.function_name = None
         self.call_count = 0
-        self.sys_init()
+        if bootstrap:
+            self.sys_init()
 
     def _get_call_count(self):
         count = self.call_count
@@ -190,206 +373,440 @@ class CodeWriter(object):
     def sys_init(self):
         lines = []
         # SP init
-        lines.append("@256")
-        lines.append("D=A")
-        lines.append("@SP")
-        lines.append("M=D")
+        lines.append(a_command("256"))
+        lines.append(c_command("D", "A"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("M", "D"))
         self.writelines(lines)
         self.writeCall("Sys.init", "0")
 
-    #def setFileName(self, file_path):
-        #f = open("{}.asm".format(file_path), "w")
-        #self.file = f
+    def setFileName(self, file_path):
+        # static variables are named after the vm file being translated
+        self.file_name = os.path.splitext(os.path.basename(file_path))[0]
+        self.static_name = self.file_name
+        if self.fragment_mode:
+            self.label_prefix = "{}$".format(self.file_name)
+
+    def _label(self, label):
+        if self.function_name:
+            return "{}${}".format(self.function_name, label)
+        return label
 
     def writelines(self, lines):
-        lines = map(lambda x: x + "\n", lines)
-        self.file.writelines(lines)
+        self.buffer.extend(lines)
+        # only a file is written in chunks; the peephole pass needs to see
+        # across commands, so it holds everything until close()
+        if len(self.buffer) >= FLUSH_LINES and self.full_path and not self.optimize:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.file.write(asm_text(self.buffer))
+            self.buffer = []
+
+    def _use_subroutine(self, name):
+        if name not in self.subroutines:
+            self.subroutines.append(name)
+        return "$${}".format(name)
+
+    def _jump_subroutine(self, name):
+        # return address in D, then jump to the shared subroutine
+        lines = []
+        return_address = "{}$$ret{}".format(self.file_name, self._get_call_count())
+        lines.append(a_command(return_address))
+        lines.extend(self._cached_lines(("jump", name), self._jump_lines, self._use_subroutine(name)))
+        lines.append(l_command(return_address))
+        return lines
+
+    def _goto_lines(self, label):
+        lines = []
+        lines.append(a_command(label))
+        lines.append(c_command(None, "0", "JMP"))
+        return lines
+
+    def _jump_lines(self, label):
+        lines = []
+        lines.append(c_command("D", "A"))
+        lines.append(a_command(label))
+        lines.append(c_command(None, "0", "JMP"))
+        return lines
+
+    def _compare_subroutine(self, op):
+        lines = []
+        label = "$${}".format(op)
+        lines.append(l_command(label))
+        lines.append(a_command("R15"))
+        lines.append(c_command("M", "D"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("AM", "M-1"))
+        lines.append(c_command("D", "M"))
+        lines.append(c_command("A", "A-1"))
+        lines.append(c_command("D", "M-D"))
+        lines.append(c_command("M", "-1"))
+        lines.append(a_command("{}.end".format(label)))
+        lines.append(c_command(None, "D", COMPARE_JUMPS[op]))
+        lines.append(a_command("SP"))
+        lines.append(c_command("A", "M-1"))
+        lines.append(c_command("M", "0"))
+        lines.append(l_command("{}.end".format(label)))
+        lines.append(a_command("R15"))
+        lines.append(c_command("A", "M"))
+        lines.append(c_command(None, "0", "JMP"))
+        return lines
+
+    def _call_subroutine(self):
+        # expects the return address in D, the argument count in R13 and the callee in R14
+        lines = []
+        lines.append(l_command("$$call"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("AM", "M+1"))
+        lines.append(c_command("A", "A-1"))
+        lines.append(c_command("M", "D"))
+        for segment in ["local", "argument", "this", "that"]:
+            lines.append(a_command(SEG_CONS[segment]))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("AM", "M+1"))
+            lines.append(c_command("A", "A-1"))
+            lines.append(c_command("M", "D"))
+        # ARG = SP - n - 5
+        lines.append(a_command("R13"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("5"))
+        lines.append(c_command("D", "D+A"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("D", "M-D"))
+        lines.append(a_command("ARG"))
+        lines.append(c_command("M", "D"))
+        # LCL = SP
+        lines.append(a_command("SP"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("LCL"))
+        lines.append(c_command("M", "D"))
+        lines.append(a_command("R14"))
+        lines.append(c_command("A", "M"))
+        lines.append(c_command(None, "0", "JMP"))
+        return lines
+
+    def _subroutine_lines(self, name):
+        if name in COMPARE_JUMPS:
+            return self._compare_subroutine(name)
+        elif name == "call":
+            return self._call_subroutine()
+        elif name == "return":
+            return [l_command("$$return")] + self._return_lines()
+
+    def _cached_lines(self, key, build, *args):
+        # code without labels depends only on its command, so key names it and
+        # build(*args) runs once; see COMMAND_LINES
+        lines = COMMAND_LINES.get(key)
+        if lines is None:
+            lines = COMMAND_LINES[key] = tuple(build(*args))
+        return lines
+
+    def _spill_top(self):
+        if not self.top_in_d:
+            return
+        self.top_in_d = False
+        self.writelines(SPILL_TOP)
+
+    def _load_top(self):
+        if self.top_in_d:
+            return []
+        self.top_in_d = True
+        return list(LOAD_TOP)
+
+    def _cached_arithmetic(self, op):
+        lines = self._load_top()
+        if op in CACHED_UNARY_OPS:
+            lines.append(CACHED_UNARY_OPS[op])
+            return lines
+
+        lines.append(a_command("SP"))
+        lines.append(c_command("AM", "M-1"))
+        if op in CACHED_BINARY_OPS:
+            lines.append(CACHED_BINARY_OPS[op])
+            return lines
+
+        if op == "eq":
+            self.eq_if_use_count += 1
+            count = self.eq_if_use_count
+        elif op == "gt":
+            self.gt_if_use_count += 1
+            count = self.gt_if_use_count
+        else:
+            self.lt_if_use_count += 1
+            count = self.lt_if_use_count
+        name = op.upper()
+        lines.append(c_command("D", "M-D"))
+        lines.append(a_command("{}{}IF{}".format(self.label_prefix, name, count)))
+        lines.append(c_command(None, "D", COMPARE_JUMPS[op]))
+        lines.append(c_command("D", "0"))
+        lines.append(a_command("{}{}END{}".format(self.label_prefix, name, count)))
+        lines.append(c_command(None, "0", "JMP"))
+        lines.append(l_command("{}{}IF{}".format(self.label_prefix, name, count)))
+        lines.append(c_command("D", "-1"))
+        lines.append(l_command("{}{}END{}".format(self.label_prefix, name, count)))
+        return lines
+
+    def _cached_push(self, segment, index):
+        # loads the pushed value into D; the old top is spilled first
+        lines = []
+        if segment == "constant":
+            lines.append(a_command(index))
+            lines.append(c_command("D", "A"))
+        elif segment in SEG_CONS:
+            if int(index) == 0:
+                lines.append(a_command(SEG_CONS[segment]))
+                lines.append(c_command("A", "M"))
+            else:
+                lines.append(a_command(index))
+                lines.append(c_command("D", "A"))
+                lines.append(a_command(SEG_CONS[segment]))
+                lines.append(c_command("A", "D+M"))
+            lines.append(c_command("D", "M"))
+        elif segment in SEG_BASE:
+            lines.append(a_command(SEG_BASE[segment] + int(index)))
+            lines.append(c_command("D", "M"))
+        elif segment == "static":
+            lines.append(a_command("{}.{}".format(self.static_name, index)))
+            lines.append(c_command("D", "M"))
+        return lines
+
+    def _cached_pop(self, segment, index):
+        # stores D; the top is loaded into D first
+        lines = []
+        if segment in SEG_CONS:
+            lines.append(a_command(SEG_CONS[segment]))
+            lines.append(c_command("A", "M"))
+            if int(index) <= 6:
+                for i in range(int(index)):
+                    lines.append(c_command("A", "A+1"))
+            else:
+                # address needs D, so park the value in R13 and the address in R14
+                lines.pop()
+                lines.pop()
+                lines.append(a_command("R13"))
+                lines.append(c_command("M", "D"))
+                lines.append(a_command(index))
+                lines.append(c_command("D", "A"))
+                lines.append(a_command(SEG_CONS[segment]))
+                lines.append(c_command("D", "D+M"))
+                lines.append(a_command("R14"))
+                lines.append(c_command("M", "D"))
+                lines.append(a_command("R13"))
+                lines.append(c_command("D", "M"))
+                lines.append(a_command("R14"))
+                lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "D"))
+        elif segment in SEG_BASE:
+            lines.append(a_command(SEG_BASE[segment] + int(index)))
+            lines.append(c_command("M", "D"))
+        elif segment == "static":
+            lines.append(a_command("{}.{}".format(self.static_name, index)))
+            lines.append(c_command("M", "D"))
+        return lines
 
     def writeArithmetic(self, op):
+        if self.cache_top and not (self.compact and op in COMPARE_JUMPS):
+            self.writelines(self._cached_arithmetic(op))
+            return
+
+        self._spill_top()
+        if self.compact and op in COMPARE_JUMPS:
+            self.writelines(self._jump_subroutine(op))
+            return
+        if op in COMPARE_JUMPS:
+            self.writelines(self._arithmetic_lines(op))
+            return
+
+        self.writelines(self._cached_lines(op, self._arithmetic_lines, op))
+
+    def _arithmetic_lines(self, op):
         lines = []
-        lines.append("@SP")
-        lines.append("M=M-1")
+        lines.append(a_command("SP"))
+        lines.append(c_command("M", "M-1"))
         if op == "add":
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M")
-            lines.append("@SP")
-            lines.append("M=M-1")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=D+M")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=D")
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("M", "M-1"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "D+M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "D"))
         elif op == "sub":
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=-M")
-            lines.append("@SP")
-            lines.append("M=M-1")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=D+M")
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "-M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("M", "M-1"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "D+M"))
         elif op == "neg":
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=-M")
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "-M"))
         elif op == "eq":
             self.eq_if_use_count += 1
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M")
-            lines.append("@SP")
-            lines.append("M=M-1")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=D-M")
-            lines.append("@EQIF{}".format(self.eq_if_use_count))
-            lines.append("D;JEQ")
-            lines.append("@EQELSE{}".format(self.eq_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(EQIF{})".format(self.eq_if_use_count))
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=1")
-            lines.append("@EQEND{}".format(self.eq_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(EQELSE{})".format(self.eq_if_use_count))
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=0")
-            lines.append("@EQEND{}".format(self.eq_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(EQEND{})".format(self.eq_if_use_count))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("M", "M-1"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "D-M"))
+            lines.append(a_command("{}EQIF{}".format(self.label_prefix, self.eq_if_use_count)))
+            lines.append(c_command(None, "D", "JEQ"))
+            lines.append(a_command("{}EQELSE{}".format(self.label_prefix, self.eq_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}EQIF{}".format(self.label_prefix, self.eq_if_use_count)))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "-1"))
+            lines.append(a_command("{}EQEND{}".format(self.label_prefix, self.eq_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}EQELSE{}".format(self.label_prefix, self.eq_if_use_count)))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "0"))
+            lines.append(a_command("{}EQEND{}".format(self.label_prefix, self.eq_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}EQEND{}".format(self.label_prefix, self.eq_if_use_count)))
         elif op == "gt":
             self.gt_if_use_count += 1
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M")
-            lines.append("@SP")
-            lines.append("M=M-1")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M-D")
-            lines.append("@GTIF{}".format(self.gt_if_use_count))
-            lines.append("D;JGT")
-            lines.append("@GTELSE{}".format(self.gt_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(GTIF{})".format(self.gt_if_use_count))
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=1")
-            lines.append("@GTEND{}".format(self.gt_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(GTELSE{})".format(self.gt_if_use_count))
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=0")
-            lines.append("@GTEND{}".format(self.gt_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(GTEND{})".format(self.gt_if_use_count))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("M", "M-1"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M-D"))
+            lines.append(a_command("{}GTIF{}".format(self.label_prefix, self.gt_if_use_count)))
+            lines.append(c_command(None, "D", "JGT"))
+            lines.append(a_command("{}GTELSE{}".format(self.label_prefix, self.gt_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}GTIF{}".format(self.label_prefix, self.gt_if_use_count)))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "-1"))
+            lines.append(a_command("{}GTEND{}".format(self.label_prefix, self.gt_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}GTELSE{}".format(self.label_prefix, self.gt_if_use_count)))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "0"))
+            lines.append(a_command("{}GTEND{}".format(self.label_prefix, self.gt_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}GTEND{}".format(self.label_prefix, self.gt_if_use_count)))
         elif op == "lt":
             self.lt_if_use_count += 1
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M")
-            lines.append("@SP")
-            lines.append("M=M-1")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M-D")
-            lines.append("@LTIF{}".format(self.lt_if_use_count))
-            lines.append("D;JLT")
-            lines.append("@LTELSE{}".format(self.lt_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(LTIF{})".format(self.lt_if_use_count))
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=1")
-            lines.append("@LTEND{}".format(self.lt_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(LTELSE{})".format(self.lt_if_use_count))
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=0")
-            lines.append("@LTEND{}".format(self.lt_if_use_count))
-            lines.append("0;JMP")
-            lines.append("(LTEND{})".format(self.lt_if_use_count))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("M", "M-1"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M-D"))
+            lines.append(a_command("{}LTIF{}".format(self.label_prefix, self.lt_if_use_count)))
+            lines.append(c_command(None, "D", "JLT"))
+            lines.append(a_command("{}LTELSE{}".format(self.label_prefix, self.lt_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}LTIF{}".format(self.label_prefix, self.lt_if_use_count)))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "-1"))
+            lines.append(a_command("{}LTEND{}".format(self.label_prefix, self.lt_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}LTELSE{}".format(self.label_prefix, self.lt_if_use_count)))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "0"))
+            lines.append(a_command("{}LTEND{}".format(self.label_prefix, self.lt_if_use_count)))
+            lines.append(c_command(None, "0", "JMP"))
+            lines.append(l_command("{}LTEND{}".format(self.label_prefix, self.lt_if_use_count)))
         elif op == "and":
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M")
-            lines.append("@SP")
-            lines.append("M=M-1")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=D&M")
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("M", "M-1"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "D&M"))
         elif op == "or":
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("D=M")
-            lines.append("@SP")
-            lines.append("M=M-1")
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=D|M")
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("M", "M-1"))
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "D|M"))
         elif op == "not":
-            lines.append("@SP")
-            lines.append("A=M")
-            lines.append("M=!M")
-
-        lines.append("@SP")
-        lines.append("M=M+1")
+            lines.append(a_command("SP"))
+            lines.append(c_command("A", "M"))
+            lines.append(c_command("M", "!M"))
 
-        self.writelines(lines)
+        lines.append(a_command("SP"))
+        lines.append(c_command("M", "M+1"))
+        return lines
 
     def _push_constant(self, index):
         lines = []
-        lines.append("@{}".format(index))
-        lines.append("D=A")
-        lines.append("@SP")
-        lines.append("A=M")
-        lines.append("M=D")
-        lines.append("@SP")
-        lines.append("M=M+1")
+        lines.append(a_command(index))
+        lines.append(c_command("D", "A"))
+        lines.extend(PUSH_TAIL)
         return lines
 
     def _push_segment(self, segment, index):
         lines = []
-        lines.append("@{}".format(index))
-        lines.append("D=A")
-        lines.append("@{}".format(SEG_CONS[segment]))
-        lines.append("A=M+D")
-        lines.append("D=M")
-        lines.append("@SP")
-        lines.append("A=M")
-        lines.append("M=D")
-        lines.append("@SP")
-        lines.append("M=M+1")
+        lines.append(a_command(index))
+        lines.append(c_command("D", "A"))
+        lines.append(a_command(SEG_CONS[segment]))
+        lines.append(c_command("A", "D+M"))
+        lines.append(c_command("D", "M"))
+        lines.extend(PUSH_TAIL)
         return lines
 
     def _pop_segment(self, segment, index):
         lines = []
         # sp decrement
-        lines.append("@SP")
-        lines.append("M=M-1")
+        lines.extend(POP_SEGMENT_HEAD)
         # add arg + index
-        lines.append("@{}".format(index))
-        lines.append("D=A")
-        lines.append("@{}".format(SEG_CONS[segment]))
-        lines.append("D=M+D")
-        lines.append("@13")
-        lines.append("M=D")
-        lines.append("@SP")
-        lines.append("A=M")
-        lines.append("D=M")
-        # set (arg + i) sp value
-        lines.append("@13")
-        lines.append("A=M")
-        lines.append("M=D")
+        lines.append(a_command(index))
+        lines.append(c_command("D", "A"))
+        lines.append(a_command(SEG_CONS[segment]))
+        lines.append(c_command("D", "D+M"))
+        # set (arg + i) sp value through R13
+        lines.extend(POP_SEGMENT_TAIL)
         return lines
 
     def writePushPop(self, op, segment, index):
+        static_name = self.static_name if segment == "static" else None
+        if self.cache_top:
+            if op == "push":
+                self._spill_top()
+                self.top_in_d = True
+                self.writelines(self._cached_lines(("push top", segment, index, static_name), self._cached_push,
+                        segment, index))
+            else:
+                self.writelines(self._load_top())
+                self.top_in_d = False
+                self.writelines(self._cached_lines(("pop top", segment, index, static_name), self._cached_pop,
+                        segment, index))
+            return
+
+        self.writelines(self._cached_lines((op, segment, index, static_name), self._push_pop_lines, op, segment, index))
+
+    def _push_pop_lines(self, op, segment, index):
         lines = []
         if op == "push":
             if segment == "constant":
@@ -397,255 +814,642 @@ class CodeWriter(object):
             elif segment in ("local", "argument", "this", "that"):
                 lines.extend(self._push_segment(segment, index))
             elif segment == "temp":
-                lines.append("@5")
-                lines.append("D=A")
-                lines.append("@{}".format(index))
-                lines.append("A=A+D")
-                lines.append("D=M")
-                lines.append("@SP")
-                lines.append("A=M")
-                lines.append("M=D")
-                lines.append("@SP")
-                lines.append("M=M+1")
+                lines.append(a_command("5"))
+                lines.append(c_command("D", "A"))
+                lines.append(a_command(index))
+                lines.append(c_command("A", "D+A"))
+                lines.append(c_command("D", "M"))
+                lines.extend(PUSH_TAIL)
             elif segment == "pointer":
-                lines.append("@3")
-                lines.append("D=A")
-                lines.append("@{}".format(index))
-                lines.append("A=A+D")
-                lines.append("D=M")
-                lines.append("@SP")
-                lines.append("A=M")
-                lines.append("M=D")
-                lines.append("@SP")
-                lines.append("M=M+1")
+                lines.append(a_command("3"))
+                lines.append(c_command("D", "A"))
+                lines.append(a_command(index))
+                lines.append(c_command("A", "D+A"))
+                lines.append(c_command("D", "M"))
+                lines.extend(PUSH_TAIL)
             elif segment == "static":
-                lines.append("@{}.{}".format(self.file_name, index))
-                lines.append("D=M")
-                lines.append("@SP")
-                lines.append("A=M")
-                lines.append("M=D")
-                lines.append("@SP")
-                lines.append("M=M+1")
+                lines.append(a_command("{}.{}".format(self.static_name, index)))
+                lines.append(c_command("D", "M"))
+                lines.extend(PUSH_TAIL)
         elif op == "pop":
             if segment in ("local", "argument", "this", "that"):
                 lines.extend(self._pop_segment(segment, index))
             elif segment == "temp":
-                lines.append("@SP")
-                lines.append("M=M-1")
-                lines.append("@5")
-                lines.append("D=A")
-                lines.append("@{}".format(index))
-                lines.append("D=D+A")
-                lines.append("@13")
-                lines.append("M=D")
-                lines.append("@SP")
-                lines.append("A=M")
-                lines.append("D=M")
-                lines.append("@13")
-                lines.append("A=M")
-                lines.append("M=D")
+                lines.extend(POP_SEGMENT_HEAD)
+                lines.append(a_command("5"))
+                lines.append(c_command("D", "A"))
+                lines.append(a_command(index))
+                lines.append(c_command("D", "D+A"))
+                lines.extend(POP_SEGMENT_TAIL)
             elif segment == "pointer":
-                lines.append("@SP")
-                lines.append("M=M-1")
-                lines.append("@3")
-                lines.append("D=A")
-                lines.append("@{}".format(index))
-                lines.append("D=D+A")
-                lines.append("@13")
-                lines.append("M=D")
-                lines.append("@SP")
-                lines.append("A=M")
-                lines.append("D=M")
-                lines.append("@13")
-                lines.append("A=M")
-                lines.append("M=D")
+                lines.extend(POP_SEGMENT_HEAD)
+                lines.append(a_command("3"))
+                lines.append(c_command("D", "A"))
+                lines.append(a_command(index))
+                lines.append(c_command("D", "D+A"))
+                lines.extend(POP_SEGMENT_TAIL)
             elif segment == "static":
-                lines.append("@SP")
-                lines.append("M=M-1")
-                lines.append("@SP")
-                lines.append("A=M")
-                lines.append("D=M")
-                lines.append("@{}.{}".format(self.file_name, index))
-                lines.append("M=D")
-
-        self.writelines(lines)
+                lines.append(a_command("SP"))
+                lines.append(c_command("M", "M-1"))
+                lines.append(a_command("SP"))
+                lines.append(c_command("A", "M"))
+                lines.append(c_command("D", "M"))
+                lines.append(a_command("{}.{}".format(self.static_name, index)))
+                lines.append(c_command("M", "D"))
+        return lines
 
     def writeLabel(self, label):
+        self._spill_top()
         lines = []
-        lines.append("({})".format(label))
+        lines.append(l_command(self._label(label)))
         self.writelines(lines)
  
     def writeGoto(self, label):
+        self._spill_top()
         lines = []
-        lines.append("@{}".format(label))
-        lines.append("0;JMP")
+        lines.append(a_command(self._label(label)))
+        lines.append(c_command(None, "0", "JMP"))
         self.writelines(lines)
 
     def writeIf(self, label):
         lines = []
-        lines.append("@SP")
-        lines.append("AM=M-1")
-        lines.append("D=M")
-        lines.append("@{}".format(label))
-        lines.append("D;JNE")
+        if self.top_in_d:
+            # the condition is already in D
+            self.top_in_d = False
+        else:
+            lines.append(a_command("SP"))
+            lines.append(c_command("AM", "M-1"))
+            lines.append(c_command("D", "M"))
+        lines.append(a_command(self._label(label)))
+        lines.append(c_command(None, "D", "JNE"))
         self.writelines(lines)
 
     def writeFunction(self, functionName, argsCountstr):
+        self._spill_top()
         lines = []
-        lines.append("({})".format(functionName))
+        self.function_name = functionName
+        lines.append(l_command(functionName))
         argsCount = int(argsCountstr)
         while argsCount > 0:
-            self._push_constant(0)
+            lines.extend(self._push_constant(0))
             argsCount -= 1
         self.writelines(lines)
 
     def writeCall(self, functionName, args):
+        self._spill_top()
+        if self.compact:
+            lines = list(self._cached_lines(("call", functionName, args), self._compact_call_lines, functionName, args))
+            lines.extend(self._jump_subroutine("call"))
+            self.writelines(lines)
+            return
+
         lines = []
         return_address = "{}f{}.c{}".format(self.file_name, functionName, self._get_call_count())
         # add return address sp
-        lines.append("@{}".format(return_address))
-        lines.append("D=A")
-        lines.append("@SP")
-        lines.append("A=M")
-        lines.append("M=D")
-        lines.append("@SP")
-        lines.append("M=M+1")
+        lines.append(a_command(return_address))
+        lines.append(c_command("D", "A"))
+        lines.extend(PUSH_TAIL)
         # push segments
-        segments = ["local", "argument", "this", "that"]
-        for segment in segments:
-            self._push_segment(segment, 0)
-        # ARG = SP - n - 5
-        lines.append("@{}".format(5 + int(args)))
-        lines.append("D=A")
-        lines.append("@SP")
-        lines.append("D=M-D")
-        lines.append("@ARG")
-        lines.append("M=D")
-        # LCL = SP
-        lines.append("@SP")
-        lines.append("D=M")
-        lines.append("@LCL")
-        lines.append("M=D")
+        lines.extend(CALLER_FRAME)
+        # ARG = SP - n - 5, LCL = SP
+        lines.append(a_command(5 + int(args)))
+        lines.extend(CALLEE_FRAME)
         # jump function
-        lines.append("@{}".format(functionName))
-        lines.append("0;JMP")
+        lines.append(a_command(functionName))
+        lines.append(c_command(None, "0", "JMP"))
         # write return address label
-        lines.append("({})".format(return_address))
+        lines.append(l_command(return_address))
         self.writelines(lines)
 
+    def _compact_call_lines(self, functionName, args):
+        # R13 = n, R14 = the function, for the shared call subroutine
+        lines = []
+        lines.append(a_command(args))
+        lines.append(c_command("D", "A"))
+        lines.append(a_command("R13"))
+        lines.append(c_command("M", "D"))
+        lines.append(a_command(functionName))
+        lines.append(c_command("D", "A"))
+        lines.append(a_command("R14"))
+        lines.append(c_command("M", "D"))
+        return lines
+
+    def _push_symbol(self, symbol):
+        lines = []
+        lines.append(a_command(symbol))
+        lines.append(c_command("D", "M"))
+        lines.extend(PUSH_TAIL)
+        return lines
+
     def _set_symbol_value_to_dreg(self, symbol):
         lines = []
-        lines.append("@{}".format(symbol))
-        lines.append("D=M")
+        lines.append(a_command(symbol))
+        lines.append(c_command("D", "M"))
         return lines
 
     def _sub_dreg_value(self, index):
         lines = []
-        lines.append("@{}".format(index))
-        lines.append("D=D-A")
+        lines.append(a_command(index))
+        lines.append(c_command("D", "D-A"))
         return lines
         
     def writeReturn(self):
+        self._spill_top()
+        if self.compact:
+            self.writelines(self._cached_lines(("goto", "return"), self._goto_lines, self._use_subroutine("return")))
+            return
+
+        self.writelines(self._cached_lines("return", self._return_lines))
+
+    def _return_lines(self):
         lines = []
         # save lcl address to r13
-        lines.append("@{}".format(SEG_CONS["local"]))
-        lines.append("D=M")
-        lines.append("@R13")
-        lines.append("M=D")
+        lines.append(a_command(SEG_CONS["local"]))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("R13"))
+        lines.append(c_command("M", "D"))
         # get return address and save to r14
-        lines.append("@5")
-        lines.append("A=D-A")
-        lines.append("D=M") 
-        lines.append("@R14")
-        lines.append("M=D")
+        lines.append(a_command("5"))
+        lines.append(c_command("A", "D-A"))
+        lines.append(c_command("D", "M")) 
+        lines.append(a_command("R14"))
+        lines.append(c_command("M", "D"))
         # return value move
-        lines.append("@SP")
-        lines.append("A=M-1")
-        lines.append("D=M")
-        lines.append("@ARG")
-        lines.append("A=M")
-        lines.append("M=D")
-        lines.append("@ARG")
-        lines.append("D=M+1")
-        lines.append("@SP")
-        lines.append("M=D")
+        lines.append(a_command("SP"))
+        lines.append(c_command("A", "M-1"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("ARG"))
+        lines.append(c_command("A", "M"))
+        lines.append(c_command("M", "D"))
+        lines.append(a_command("ARG"))
+        lines.append(c_command("D", "M+1"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("M", "D"))
         # set saved that 
         lines.extend(self._set_symbol_value_to_dreg("R13"))
         lines.extend(self._sub_dreg_value(1))
-        lines.append("A=D")
-        lines.append("D=M")
-        lines.append("@THAT")
-        lines.append("M=D")
+        lines.append(c_command("A", "D"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("THAT"))
+        lines.append(c_command("M", "D"))
         # set saved this
         lines.extend(self._set_symbol_value_to_dreg("R13"))
         lines.extend(self._sub_dreg_value(2))
-        lines.append("A=D")
-        lines.append("D=M")
-        lines.append("@THIS")
-        lines.append("M=D")
+        lines.append(c_command("A", "D"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("THIS"))
+        lines.append(c_command("M", "D"))
         # set saved arg
         lines.extend(self._set_symbol_value_to_dreg("R13"))
         lines.extend(self._sub_dreg_value(3))
-        lines.append("A=D")
-        lines.append("D=M")
-        lines.append("@ARG")
-        lines.append("M=D")
+        lines.append(c_command("A", "D"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("ARG"))
+        lines.append(c_command("M", "D"))
         # set saved lcl
         lines.extend(self._set_symbol_value_to_dreg("R13"))
         lines.extend(self._sub_dreg_value(4))
-        lines.append("A=D")
-        lines.append("D=M")
-        lines.append("@LCL")
-        lines.append("M=D")
+        lines.append(c_command("A", "D"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("LCL"))
+        lines.append(c_command("M", "D"))
+        lines.append(a_command("R14"))
+        lines.append(c_command("A", "M"))
+        lines.append(c_command(None, "0", "JMP"))
+        return lines
+
+    def writeInlineCall(self, args, saved, localsCount):
+        # frame of an inlined function: only the registers in saved are kept,
+        # with no return address; ARG is always set since the return value goes there
+        self._spill_top()
+        lines = []
+        for symbol in saved:
+            lines.extend(self._push_symbol(symbol))
+        # ARG = SP - n - len(saved)
+        lines.append(a_command(len(saved) + int(args)))
+        lines.append(c_command("D", "A"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("D", "M-D"))
+        lines.append(a_command("ARG"))
+        lines.append(c_command("M", "D"))
+        if "LCL" in saved:
+            lines.append(a_command("SP"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command("LCL"))
+            lines.append(c_command("M", "D"))
+            for i in range(int(localsCount)):
+                lines.extend(self._push_constant(0))
         self.writelines(lines)
-        lines.append("@R14")
-        lines.append("A=M")
-        lines.append("0;JMP")
 
-    def close(self):
+    def writeInlineReturn(self, args, saved, end_label=None):
+        self._spill_top()
+        lines = []
+        # the saved registers start right after the arguments
+        lines.append(a_command("ARG"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command(args))
+        lines.append(c_command("D", "D+A"))
+        lines.append(a_command("R13"))
+        lines.append(c_command("M", "D"))
+        # return value to r14
+        lines.append(a_command("SP"))
+        lines.append(c_command("A", "M-1"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("R14"))
+        lines.append(c_command("M", "D"))
+        # SP = ARG + 1
+        lines.append(a_command("ARG"))
+        lines.append(c_command("D", "M+1"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("M", "D"))
+        # restore the frame before the return value may overwrite it
+        for i, symbol in enumerate(saved):
+            lines.append(a_command("R13"))
+            if i == 0:
+                lines.append(c_command("A", "M"))
+            else:
+                lines.append(c_command("D", "M"))
+                lines.append(a_command(i))
+                lines.append(c_command("A", "D+A"))
+            lines.append(c_command("D", "M"))
+            lines.append(a_command(symbol))
+            lines.append(c_command("M", "D"))
+        lines.append(a_command("R14"))
+        lines.append(c_command("D", "M"))
+        lines.append(a_command("SP"))
+        lines.append(c_command("A", "M-1"))
+        lines.append(c_command("M", "D"))
+        if end_label:
+            lines.append(a_command(self._label(end_label)))
+            lines.append(c_command(None, "0", "JMP"))
+        self.writelines(lines)
+
+    def fragment(self):
+        # translated code of a fragment writer and the shared subroutines it uses
+        self._spill_top()
+        lines = peephole(self.buffer) if self.optimize else self.buffer
+        return lines, self.subroutines
+
+    def finish(self):
+        # append the END loop and the shared subroutines; returns the unwritten records
+        self._spill_top()
         lines = []
-        lines.append("(END)")
-        lines.append("@END")
-        lines.append("0;JMP")
+        lines.append(l_command("END"))
+        lines.append(a_command("END"))
+        lines.append(c_command(None, "0", "JMP"))
+        for name in self.subroutines:
+            lines.extend(self._subroutine_lines(name))
         self.writelines(lines)
+        if self.optimize:
+            self.buffer = peephole(self.buffer)
+        return self.buffer
+
+    def close(self):
+        self.finish()
+        self._flush()
+        value = self.file.getvalue() if self.full_path is None else None
         self.file.close()
+        return value
+
+
+COMMAND_WRITERS = {opcode: (lambda writer, command: writer.writeArithmetic(command.opcode.value))
+        for opcode in ARITHMETIC_OPCODES}
+COMMAND_WRITERS.update({
+    Opcode.PUSH: lambda writer, command: writer.writePushPop("push", command.segment.value, command.index),
+    Opcode.POP: lambda writer, command: writer.writePushPop("pop", command.segment.value, command.index),
+    Opcode.LABEL: lambda writer, command: writer.writeLabel(command.name),
+    Opcode.GOTO: lambda writer, command: writer.writeGoto(command.name),
+    Opcode.IF_GOTO: lambda writer, command: writer.writeIf(command.name),
+    Opcode.FUNCTION: lambda writer, command: writer.writeFunction(command.name, command.index),
+    Opcode.CALL: lambda writer, command: writer.writeCall(command.name, command.index),
+    Opcode.RETURN: lambda writer, command: writer.writeReturn(),
+})
+
+
+def write_command(writer, command):
+    COMMAND_WRITERS[command.opcode](writer, command)
+
+
+def split_functions(commands):
+    # commands before the first function form their own group
+    functions = [[]]
+    for command in commands:
+        if command.opcode == Opcode.FUNCTION:
+            functions.append([])
+        functions[-1].append(command)
+    return [function for function in functions if function]
+
+
+def is_push_constant(command):
+    return command.opcode == Opcode.PUSH and command.segment == Segment.CONSTANT
+
+
+def push_constant(value):
+    return Command(Opcode.PUSH, Segment.CONSTANT, value)
+
+
+def fold_value(opcode, x, y=None):
+    # the folded constant, or None when it is not a valid push constant
+    if opcode == Opcode.ADD:
+        value = x + y
+    elif opcode == Opcode.SUB:
+        value = x - y
+    elif opcode == Opcode.AND:
+        value = x & y
+    elif opcode == Opcode.OR:
+        value = x | y
+    elif opcode == Opcode.NEG:
+        value = -x
+    else:
+        return None
+    if 0 <= value <= 32767:
+        return value
+    return None
+
+
+FOLD_BINARY = (Opcode.ADD, Opcode.SUB, Opcode.AND, Opcode.OR)
+FOLD_COMPARE = {Opcode.EQ: lambda x, y: x == y, Opcode.GT: lambda x, y: x > y, Opcode.LT: lambda x, y: x < y}
+
+
+def fold_constants(commands):
+    out = []
+    for command in commands:
+        out.append(command)
+        while True:
+            opcode = out[-1].opcode
+            if len(out) >= 3 and (opcode in FOLD_BINARY or opcode in FOLD_COMPARE) \
+                    and is_push_constant(out[-3]) and is_push_constant(out[-2]):
+                x = out[-3].index
+                y = out[-2].index
+                if opcode in FOLD_COMPARE:
+                    # true is -1, which push constant cannot express directly
+                    replacement = [push_constant(0)]
+                    if FOLD_COMPARE[opcode](x, y):
+                        replacement.append(Command(Opcode.NOT))
+                else:
+                    value = fold_value(opcode, x, y)
+                    if value is None:
+                        break
+                    replacement = [push_constant(value)]
+                out[-3:] = replacement
+            elif len(out) >= 2 and opcode == Opcode.NEG and is_push_constant(out[-2]):
+                value = fold_value(opcode, out[-2].index)
+                if value is None:
+                    break
+                out[-2:] = [push_constant(value)]
+            elif len(out) >= 3 and opcode == Opcode.IF_GOTO and out[-3] == push_constant(0) \
+                    and out[-2].opcode == Opcode.NOT:
+                out[-3:] = [Command(Opcode.GOTO, name=out[-1].name)]
+            elif len(out) >= 2 and opcode == Opcode.IF_GOTO and is_push_constant(out[-2]):
+                name = out[-1].name
+                out[-2:] = [Command(Opcode.GOTO, name=name)] if out[-2].index else []
+                if not out:
+                    break
+            else:
+                break
+    return out
+
+
+def remove_unused_labels(commands):
+    used = set(command.name for command in commands if command.opcode in (Opcode.GOTO, Opcode.IF_GOTO))
+    return [command for command in commands if command.opcode != Opcode.LABEL or command.name in used]
+
+
+def remove_dead_code(commands):
+    # nothing after goto or return runs until the next label
+    out = []
+    reachable = True
+    for command in commands:
+        if command.opcode in (Opcode.LABEL, Opcode.FUNCTION):
+            reachable = True
+        if command.opcode == Opcode.LABEL and out and out[-1] == Command(Opcode.GOTO, name=command.name):
+            # jump to the very next command
+            out.pop()
+        if reachable:
+            out.append(command)
+        if command.opcode in (Opcode.GOTO, Opcode.RETURN):
+            reachable = False
+    return out
+
+
+def optimize_commands(commands):
+    optimized = []
+    for function in split_functions(commands):
+        while True:
+            result = remove_dead_code(remove_unused_labels(fold_constants(function)))
+            if result == function:
+                break
+            function = result
+        optimized.extend(function)
+    return optimized
+
+
+INLINE_SIZE = 16
+INLINE_BUDGET = 4096
+
+
+def call_graph(functions):
+    return dict((name, set(command.name for command in body if command.opcode == Opcode.CALL))
+            for name, body in functions.items())
+
+
+def is_recursive(name, graph):
+    stack = list(graph.get(name, ()))
+    seen = set()
+    while stack:
+        callee = stack.pop()
+        if callee == name:
+            return True
+        if callee not in seen:
+            seen.add(callee)
+            stack.extend(graph.get(callee, ()))
+    return False
+
+
+class InlineFunction(object):
+    __slots__ = ("file_name", "locals_count", "body", "saved")
+
+    def __init__(self, file_name, function):
+        self.file_name = file_name
+        self.locals_count = function[0].index
+        self.body = function[1:]
+        segments = set(command.segment for command in self.body)
+        pops = set((command.segment, command.index) for command in self.body if command.opcode == Opcode.POP)
+        self.saved = ["ARG"]
+        if Segment.LOCAL in segments:
+            self.saved.append("LCL")
+        # a real return restores THIS and THAT, so they are kept when the body sets them
+        if (Segment.POINTER, 0) in pops:
+            self.saved.append("THIS")
+        if (Segment.POINTER, 1) in pops:
+            self.saved.append("THAT")
+
+
+class Inliner(object):
+    # expands calls to short non-recursive functions in place of the call frame;
+    # calls inside an inlined body stay real calls, and the total number of
+    # commands added is capped by budget. The call sites are chosen up front
+    # over all files in order, so --parallel workers spend the budget the same
+    # way a serial run does
+    def __init__(self, file_commands, size=INLINE_SIZE, budget=INLINE_BUDGET):
+        functions = {}
+        file_names = {}
+        for file_path, commands in file_commands:
+            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            for function in split_functions(commands):
+                if function[0].opcode == Opcode.FUNCTION:
+                    functions[function[0].name] = function
+                    file_names[function[0].name] = file_name
+        graph = call_graph(functions)
+        self.functions = {}
+        for name, function in functions.items():
+            if len(function) - 1 <= size and not is_recursive(name, graph):
+                self.functions[name] = InlineFunction(file_names[name], function)
+        # (file name, command index): site number
+        self.sites = {}
+        for file_path, commands in file_commands:
+            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            for i, command in enumerate(commands):
+                if command.opcode == Opcode.CALL and command.name in self.functions \
+                        and len(self.functions[command.name].body) <= budget:
+                    budget -= len(self.functions[command.name].body)
+                    self.sites[(file_name, i)] = len(self.sites)
+
+    def write_commands(self, writer, commands):
+        for i, command in enumerate(commands):
+            site = self.sites.get((writer.file_name, i))
+            if site is None:
+                write_command(writer, command)
+            else:
+                self.expand(writer, command, site)
+
+    def expand(self, writer, call, site):
+        function = self.functions[call.name]
+        # labels of the body are renamed per call site
+        prefix = "{}$inline{}".format(call.name, site)
+        # only statics follow the callee's file: labels, return addresses
+        # included, stay unique to the fragment being written
+        writer.static_name = function.file_name
+        writer.writeInlineCall(call.index, function.saved, function.locals_count)
+        last = len(function.body) - 1
+        for i, command in enumerate(function.body):
+            if command.opcode == Opcode.RETURN:
+                writer.writeInlineReturn(call.index, function.saved, prefix if i < last else None)
+            elif command.opcode in (Opcode.LABEL, Opcode.GOTO, Opcode.IF_GOTO):
+                write_command(writer, Command(command.opcode, name="{}${}".format(prefix, command.name)))
+            else:
+                write_command(writer, command)
+        writer.writeLabel(prefix)
+        writer.static_name = writer.file_name
+
+
+def get_inliner(options, file_commands):
+    if "--inline" not in options:
+        return None
+    return Inliner(file_commands, int(get_option_value(options, "--inline-size", INLINE_SIZE)),
+            int(get_option_value(options, "--inline-budget", INLINE_BUDGET)))
+
+
+def write_commands(writer, commands, inliner=None):
+    if inliner:
+        inliner.write_commands(writer, commands)
+    else:
+        for command in commands:
+            write_command(writer, command)
+
+
+def read_commands(file_path, options):
+    f = file_open(file_path)
+    parser = Parser(f)
+    f.close()
+    commands = parser.commands
+    if "--fold" in options:
+        commands = optimize_commands(commands)
+    return commands
+
+
+def translate_fragment(file_path, options, inliner=None):
+    # process pool worker: translate one vm file into an object fragment
+    writer = CodeWriter(None, False, "--optimize" in options, "--compact" in options, "--cache-top" in options, True)
+    writer.setFileName(file_path)
+    write_commands(writer, read_commands(file_path, options), inliner)
+    return writer.fragment()
+
+
+def link(name, fragments, bootstrap, options):
+    # bootstrap, then the fragments in the given order; close() adds END and the shared subroutines
+    writer = CodeWriter(name, bootstrap, False, "--compact" in options, "--cache-top" in options)
+    for lines, subroutines in fragments:
+        writer.writelines(lines)
+        for subroutine in subroutines:
+            writer._use_subroutine(subroutine)
+    return writer
+
+
+def translate_parallel(name, files, bootstrap, options):
+    jobs = int(get_option_value(options, "--jobs", 0)) or None
+    # inlining needs every function, so the inliner is built here and shipped to the workers
+    inliner = None
+    if "--inline" in options:
+        inliner = get_inliner(options, [(file_path, read_commands(file_path, options)) for file_path in files])
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        fragments = list(executor.map(translate_fragment, files, [options] * len(files), [inliner] * len(files)))
+    return link(name, fragments, bootstrap, options)
+
+
+def build_writer(files, options, name=None):
+    # a CodeWriter holding the translation of every file, not closed yet
+    # the bootstrap calls Sys.init, so it is only emitted when Sys.vm is translated
+    bootstrap = any(os.path.basename(file_path) == "Sys.vm" for file_path in files)
+    if "--parallel" in options:
+        return translate_parallel(name, files, bootstrap, options)
+
+    writer = CodeWriter(name, bootstrap, "--optimize" in options, "--compact" in options, "--cache-top" in options)
+    file_commands = [(file_path, read_commands(file_path, options)) for file_path in files]
+    inliner = get_inliner(options, file_commands)
+    for file_path, commands in file_commands:
+        writer.setFileName(file_path)
+        write_commands(writer, commands, inliner)
+    return writer
+
+
+def translate(files, options, name=None):
+    # writes name.asm, or returns the assembly as a string when name is None
+    return build_writer(files, options, name).close()
+
+
+def translate_to_rom(files, options, name):
+    # VM code straight to name.hack or name.bin: the writer's records go to
+    # the assembler passes with no .asm text in between; --dump-asm still
+    # writes name.asm for debugging
+    output_format = get_option_value(options, "--format", "hack")
+    if output_format not in hack_assembler.OUTPUT_FORMATS:
+        raise FileParseError("unknown output format {}".format(output_format))
+    instructions = build_writer(files, options).finish()
+    if "--dump-asm" in options:
+        with open("{}.asm".format(name), "w") as f:
+            f.write(asm_text(instructions))
+
+    symbol_table = hack_assembler.SymbolTable()
+    hack_assembler.first_pass(instructions, symbol_table)
+    words = hack_assembler.second_pass(instructions, symbol_table)
+    if output_format == "bin":
+        with open("{}.bin".format(name), "wb") as f:
+            hack_assembler.write_rom(words, f)
+    else:
+        with open("{}.hack".format(name), "w") as f:
+            hack_assembler.write_hack(words, f)
 
 
 def main():
     files = get_files()
     if not files:
         raise FileNotExistError("not passed target files")
-    writer = None
-    for file_path in files:
-        f = file_open(file_path)
-        write_file_name = file_path.rstrip(".vm")
-        parser = Parser(f)
-        if not writer:
-            writer = CodeWriter(write_file_name)
-        while True:
-            commandType = parser.commandType()
-            if commandType == CommandType.C_ARITHMETIC:
-                writer.writeArithmetic(parser.command)
-            elif commandType in (CommandType.C_PUSH, CommandType.C_POP):
-                writer.writePushPop(parser.op(), parser.arg1(), parser.arg2())
-            elif commandType == CommandType.C_LABEL:
-                writer.writeLabel(parser.arg1())
-            elif commandType == CommandType.C_GOTO:
-                writer.writeGoto(parser.arg1())
-            elif commandType == CommandType.C_CALL:
-                writer.writeCall(parser.arg1(), parser.arg2())
-            elif commandType == CommandType.C_IF:
-                writer.writeIf(parser.arg1())
-            elif commandType == CommandType.C_RETURN:
-                writer.writeReturn()
-            elif commandType == CommandType.C_FUNCTION:
-                writer.writeFunction(parser.arg1(), parser.arg2())
-
-            if not parser.hasMoreCommands():
-                break
-        
-            parser.advance()
-    writer.close()
+    options = get_options()
+    if get_option_value(options, "--format", None):
+        translate_to_rom(files, options, get_write_file_name(sys.argv[1]))
+    else:
+        translate(files, options, get_write_file_name(sys.argv[1]))
 
 def get_files():
     path = sys.argv[1]
@@ -660,7 +1464,23 @@ def get_files():
     else:
         files.append(path)
     
-    return files
+    # a stable order keeps the output identical between runs
+    return sorted(files)
+
+def get_options():
+    return [v for v in sys.argv[2:] if v.startswith("--")]
+
+def get_option_value(options, name, default):
+    for option in options:
+        if option.startswith(name + "="):
+            return option.split("=", 1)[1]
+    return default
+
+def get_write_file_name(path):
+    path = path.rstrip("/")
+    if os.path.isdir(path):
+        return os.path.join(path, os.path.basename(path))
+    return os.path.splitext(path)[0]
 
 def file_open(file_path):
     splited_file_name = file_path.split(".")
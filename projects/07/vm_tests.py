@@ -0,0 +1,97 @@
+import os
+import re
+import sys
+
+import VMtranslator
+from VMtranslator import build_writer, hack_assembler
+
+# CPUEmulator.py runs the translated programs
+EMULATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "05")
+if EMULATOR_DIR not in sys.path:
+    sys.path.append(EMULATOR_DIR)
+from CPUEmulator import CPUEmulator, EmulatorError, wrap
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+TEST_ROOTS = ["07", "08"]
+
+
+class TestScriptError(Exception):
+    pass
+
+
+def find_tests():
+    # every directory holding a NAME.tst next to its .vm files
+    tests = []
+    for root in TEST_ROOTS:
+        for dir_path, dir_names, file_names in os.walk(os.path.join(PROJECTS_DIR, root)):
+            dir_names.sort()
+            if os.path.basename(dir_path) + ".tst" in file_names:
+                tests.append(os.path.normpath(dir_path))
+    return sorted(tests)
+
+
+def read_test_script(path):
+    # the subset of the .tst language the 07/08 scripts use:
+    # returns (output RAM addresses, [(address, value)], ticks)
+    with open(path, "r") as f:
+        script = re.sub(r"//.*", "", f.read())
+    output_list = re.search(r"output-list(.*?);", script, re.S)
+    repeat = re.search(r"repeat\s+(\d+)", script)
+    if output_list is None or repeat is None:
+        raise TestScriptError("{}: no output-list or repeat".format(path))
+    addresses = [int(v) for v in re.findall(r"RAM\[(\d+)\]", output_list.group(1))]
+    settings = [(int(a), int(v)) for a, v in re.findall(r"set\s+RAM\[(\d+)\]\s+(-?\d+)", script)]
+    return addresses, settings, int(repeat.group(1))
+
+
+def read_compare_file(path):
+    # the first row of values under the header
+    with open(path, "r") as f:
+        rows = [line.strip() for line in f if line.strip()]
+    if len(rows) < 2:
+        raise TestScriptError("{}: no values".format(path))
+    return [int(v) for v in rows[1].strip("|").split("|")]
+
+
+def run_test(test_dir, options):
+    # returns (expected values, emulated values)
+    name = os.path.basename(test_dir)
+    files = sorted(os.path.join(test_dir, f) for f in os.listdir(test_dir) if f.endswith(".vm"))
+    instructions = build_writer(files, options).finish()
+    symbol_table = hack_assembler.SymbolTable()
+    hack_assembler.first_pass(instructions, symbol_table)
+    words = hack_assembler.second_pass(instructions, symbol_table)
+
+    addresses, settings, ticks = read_test_script(os.path.join(test_dir, name + ".tst"))
+    emulator = CPUEmulator(words, "--jit" in options)
+    for address, value in settings:
+        emulator.ram[address] = wrap(value)
+    emulator.run(ticks)
+    return read_compare_file(os.path.join(test_dir, name + ".cmp")), [emulator.ram[a] for a in addresses]
+
+
+def main():
+    # translator options (--optimize, --inline, ...) are passed through;
+    # --jit runs the emulator's compiled blocks
+    options = get_options()
+    tests = [os.path.normpath(v) for v in sys.argv[1:] if not v.startswith("--")] or find_tests()
+    failures = 0
+    for test_dir in tests:
+        try:
+            expected, result = run_test(test_dir, options)
+        except (VMtranslator.FileParseError, hack_assembler.CodeValidationError, EmulatorError, TestScriptError) as e:
+            expected, result = None, e
+        if expected == result:
+            print("ok    {}".format(os.path.relpath(test_dir, PROJECTS_DIR)))
+        else:
+            failures += 1
+            print("FAIL  {}: expected {}, got {}".format(os.path.relpath(test_dir, PROJECTS_DIR), expected, result))
+    print("{} of {} passed".format(len(tests) - failures, len(tests)))
+    if failures:
+        sys.exit(1)
+
+def get_options():
+    return [v for v in sys.argv[1:] if v.startswith("--")]
+
+if __name__ == "__main__":
+    main()
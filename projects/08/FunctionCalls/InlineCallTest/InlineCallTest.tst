@@ -0,0 +1,15 @@
+// Tests a real call made from an inlined function body.
+// Sys.init should leave A.f() = 142 on the stack.
+
+load InlineCallTest.asm,
+output-file InlineCallTest.out,
+compare-to InlineCallTest.cmp,
+output-list RAM[0]%D1.6.1 RAM[261]%D1.6.1;
+
+set RAM[0] 256,
+
+repeat 1000 {
+  ticktock;
+}
+
+output;